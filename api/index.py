@@ -1,14 +1,46 @@
 import os
-import requests
+import importlib.util
+import random
 import json
+import hashlib
 import logging
+import math
+import re
 import time
-from flask import Flask, request
+import mmap
+import atexit
+import sqlite3
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from flask import Flask, Response, request
 
 # --- Basic Configuration ---
 # Set up logging to see detailed output in your Vercel logs
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def lazy_import(name):
+    """Returns a module that is only executed on first attribute access.
+
+    Keeps heavy dependencies off the cold-start path of the serverless function;
+    see scripts/bench_startup.py.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+requests = lazy_import('requests')
+
 app = Flask(__name__)
 
 # --- Environment Variables ---
@@ -18,18 +50,89 @@ ADMIN_ID = os.environ.get('ADMIN_ID')
 CHANNEL_ID = os.environ.get('CHANNEL_ID')
 JSONBIN_API_KEY = os.environ.get('JSONBIN_API_KEY')
 JSONBIN_BIN_ID = os.environ.get('JSONBIN_BIN_ID')
+# User storage backend: 'sqlite' or 'jsonbin'. Defaults to JSONBin when it is configured.
+# SQLite gives point reads and a COUNT(*) for /status, but USER_DB_PATH must be
+# durable and shared; /tmp on a serverless host is neither, so JSONBin stays the
+# production store there (import into SQLite with scripts/migrate_users.py).
+USER_STORE = os.environ.get('USER_STORE', 'jsonbin' if JSONBIN_BIN_ID else 'sqlite')
+USER_DB_PATH = os.environ.get('USER_DB_PATH', '/tmp/quran_bot.db')
+# Derived caches (recitation availability, audio file_ids) always live in SQLite,
+# never in the JSONBin users document. Losing them only costs re-verification.
+CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', USER_DB_PATH)
+# Language updates are buffered and written in batches of this size, once the
+# oldest pending update is this many seconds old, or when the update that made
+# them has been handled, whichever comes first.
+USER_WRITE_BATCH_SIZE = int(os.environ.get('USER_WRITE_BATCH_SIZE', '50'))
+USER_WRITE_FLUSH_SECONDS = float(os.environ.get('USER_WRITE_FLUSH_SECONDS', '2'))
+# Channel membership answers are cached per user; negative answers expire sooner
+# so users who have just joined are let in quickly. A user who leaves keeps access
+# until their entry expires, unless the bot is an admin of the channel and the
+# webhook receives "chat_member" updates (see scripts/set_webhook.py).
+MEMBERSHIP_TTL = int(os.environ.get('MEMBERSHIP_TTL', '600'))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', '30'))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000'))
+# Serverless hosts (Vercel, AWS Lambda) freeze the process once the response is
+# sent, so nothing may be left running after it. There, updates and admin jobs
+# run before webhook() returns, and long jobs stop after SERVERLESS_TIME_BUDGET
+# seconds so they can be resumed (keep it below the function's maxDuration).
+SERVERLESS = os.environ.get('SERVERLESS', '1' if os.environ.get('VERCEL') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else '0') == '1'
+SERVERLESS_TIME_BUDGET = float(os.environ.get('SERVERLESS_TIME_BUDGET', '40'))
+# Elsewhere updates are acknowledged immediately and handled by this many worker
+# threads. Beyond UPDATE_QUEUE_SIZE waiting updates, work runs inline.
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '0' if SERVERLESS else '8'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '100'))
+# Per-user flood control: each user may send USER_RATE_BURST commands at once,
+# refilled at USER_RATE_PER_MINUTE. Throttled users are told so at most once
+# every USER_THROTTLE_NOTICE_SECONDS; further commands are dropped silently.
+USER_RATE_PER_MINUTE = float(os.environ.get('USER_RATE_PER_MINUTE', '20'))
+USER_RATE_BURST = int(os.environ.get('USER_RATE_BURST', '5'))
+USER_THROTTLE_NOTICE_SECONDS = int(os.environ.get('USER_THROTTLE_NOTICE_SECONDS', '30'))
+# Broadcasts: Telegram allows about 30 messages/second overall and 1/second per chat.
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_PROGRESS_SECONDS = int(os.environ.get('BROADCAST_PROGRESS_SECONDS', '60'))
+# Recitation availability is cached persistently; known-good URLs are re-verified
+# after AUDIO_STATUS_TTL seconds, missing ones after AUDIO_MISSING_TTL.
+AUDIO_STATUS_TTL = int(os.environ.get('AUDIO_STATUS_TTL', str(30 * 24 * 3600)))
+AUDIO_MISSING_TTL = int(os.environ.get('AUDIO_MISSING_TTL', str(24 * 3600)))
+# 'link' replies with a download link; 'file_id' sends the audio through Telegram,
+# uploading each recitation once and reusing its cached file_id afterwards.
+AUDIO_DELIVERY = os.environ.get('AUDIO_DELIVERY', 'link')
+# Chat that /backfill_audio uploads into to obtain file_ids (defaults to the admin).
+AUDIO_CACHE_CHAT_ID = os.environ.get('AUDIO_CACHE_CHAT_ID', ADMIN_ID)
+# Rendered /surah and /juz replies are memoized per (surah|juz, edition, language).
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', '256'))
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '5'))
+# Rolling window for the admin /stats percentiles. If METRICS_TOKEN is set,
+# GET /metrics requires ?token=<METRICS_TOKEN>.
+STATS_WINDOW_SECONDS = int(os.environ.get('STATS_WINDOW_SECONDS', '3600'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Shared HTTP client: pooled keep-alive connections per host, retries with
+# jittered exponential backoff, and Telegram's retry_after honored up to a cap.
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.3'))
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', '5'))
+HTTP_RETRY_AFTER_MAX = float(os.environ.get('HTTP_RETRY_AFTER_MAX', '10'))
 
 # --- Constants ---
 QURAN_API_BASE_URL = 'http://api.alquran.cloud/v1'
+# Edition served by /surah and /juz. Bundled editions are read from CORPUS_DIR,
+# anything else falls back to the alquran.cloud API. The corpus is generated at
+# deploy time by the buildCommand in vercel.json and is not checked in.
+QURAN_EDITION = os.environ.get('QURAN_EDITION', 'quran-uthmani')
+CORPUS_DIR = os.environ.get('QURAN_CORPUS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
 RECITERS = {
     'abdulbasit': {'name': 'Abdul Basit Abdus Samad', 'identifier': 'abdul_basit_murattal'},
     'yasser': {'name': 'Yasser Al-Dosari', 'identifier': 'yasser_ad-dussary'},
 }
 
 # --- All Bot Text in One Place ---
+# Frozen right after the literal so no handler can mutate the shared catalog.
 MESSAGES = {
     'am': {
-        "welcome": "🕌 Assalamu Alaikum {username}\n\n📖 ወደ ቁርአን ቦት በደህና መጡ!\n\n✍️ ለጽሁፍ የቁርአን አንቀጾች:\n\n/surah <ቁጥር> — ሱራ ቁጥር አስገባ\n/juz <ቁጥር> — ጁዝ ቁጥር አስገባ\n\n🔊 ለድምጽ (ሙሉ ሱራ ኮርኖች):\n/abdulbasit <ቁጥር> 🎙️\n/yasser <ቁጥር> 🎧\n\n⚙️ ሌሎች ትዕዛዞች:\n🌐 /language — ቋንቋ ለመቀየር\n🆘 /support <መልዕክት> — ለእርዳታ ለአድሚኑ ይላኩ",
+        "welcome": "🕌 Assalamu Alaikum {username}\n\n📖 ወደ ቁርአን ቦት በደህና መጡ!\n\n✍️ ለጽሁፍ የቁርአን አንቀጾች:\n\n/surah <ቁጥር> — ሱራ ቁጥር አስገባ\n/juz <ቁጥር> — ጁዝ ቁጥር አስገባ\n/ayah <ሱራ:አንቀጽ> — አንቀጽ ወይም የአንቀጾች ክልል (ለምሳሌ 2:255 ወይም 2:1-10)\n/search <ቃላት> — በቁርአን ውስጥ ይፈልጉ\n\n🔊 ለድምጽ (ሙሉ ሱራ ኮርኖች):\n/abdulbasit <ቁጥር> 🎙️\n/yasser <ቁጥር> 🎧\n\n⚙️ ሌሎች ትዕዛዞች:\n🌐 /language — ቋንቋ ለመቀየር\n🆘 /support <መልዕክት> — ለእርዳታ ለአድሚኑ ይላኩ",
         "language_prompt": "እባክዎ ቋንቋ ይምረጡ:",
         "language_selected": "✅ ቋንቋ ወደ አማርኛ ተቀይሯል።",
         "support_prompt": "እባክዎ ከ `/support` ትዕዛዝ በኋላ መልዕክትዎን ያስገቡ።\nምሳሌ: `/support ሰላም፣ እርዳታ እፈልጋለሁ`",
@@ -38,13 +141,24 @@ MESSAGES = {
         "join_button_text": "✅ ቻናሉን ይቀላቀሉ",
         "surah_prompt": "እባክዎ ትክክለኛ የሱራ ቁጥር ያስገቡ (1-114)።\nአጠቃቀም: `/surah 2`",
         "juz_prompt": "እባክዎ ትክክለኛ የጁዝ ቁጥር ያስገቡ (1-30)።\nአጠቃቀም: `/juz 15`",
+        "surah_header": "🕋 *Surah {number}: {name}*",
+        "juz_header": "📗 *Juz' {number}*",
+        "ayah_prompt": "እባክዎ የሱራ እና የአንቀጽ ቁጥር ያስገቡ።\nአጠቃቀም: `/ayah 2:255` ወይም `/ayah 2:1-10`",
+        "ayah_header": "📖 *{name} {reference}*",
+        "search_prompt": "እባክዎ ከ `/search` ትዕዛዝ በኋላ የሚፈልጉትን ቃል ያስገቡ።\nምሳሌ: `/search الرحمن`",
+        "search_results": "🔎 {query} — *{total}* ውጤቶች (ገጽ {page}/{pages})",
+        "search_no_results": "🔎 {query} — ምንም ውጤት አልተገኘም።",
+        "search_expired": "ይህ ፍለጋ ጊዜው አልፎበታል። እባክዎ /search እንደገና ይላኩ።",
+        "search_unavailable": "ይቅርታ፣ ፍለጋ በአሁኑ ጊዜ አይገኝም።",
+        "rate_limited": "⏳ ትዕዛዞችን በጣም በፍጥነት እየላኩ ነው። እባክዎ ትንሽ ቆይተው እንደገና ይሞክሩ።",
         "reciter_prompt": "እባክዎ ከቃሪኡ ስም ቀጥሎ የሱራውን ቁጥር ያስገቡ (1-114)።\nአጠቃቀም: `/{reciter_key} 2`",
         "audio_link_message": "🎧 *{reciter_name}*\n📖 *Surah {surah_name}*\n\n🔗 [Download / Play Audio Here]({audio_url})\n\nከላይ ያለውን ሰማያዊ ሊንክ በመጫን ድምጹን በቀጥታ ማዳመጥ ወይም ማውረድ ይችላሉ።",
+        "audio_caption": "🎧 *{reciter_name}*\n📖 *Surah {surah_name}*",
         "error_fetching_audio": "ይቅርታ፣ የድምጽ ፋይሉን ሊንክ ማግኘት አልቻልኩም።\n\n**ምክንያት:** የድምጽ ፋይሉ በድረ-ገጹ ላይ አልተገኘም (404 Error)።\n**የተሞከረው ሊንክ:** `{full_audio_url}`",
         "generic_error": "❌ አንድ ስህተት አጋጥሟል። እባክዎ ቆይተው እንደገና ይሞክሩ። ችግሩ ከቀጠለ ለአስተዳዳሪው ያሳውቁ።"
     },
     'en': {
-        "welcome": "🕌 Assalamu Alaikum {username}\n\n📖 Welcome to the Quran Bot!\n\n✍️ For Quran verses in text:\n\n/surah <number> — Enter Surah number\n/juz <number> — Enter Juz' number\n\n🔊 For Audio (Full Surah Recitations):\n/abdulbasit <number> �️\n/yasser <number> 🎧\n\n⚙️ Other Commands:\n🌐 /language — To change language\n🆘 /support <message> — Send a message to the admin for help",
+        "welcome": "🕌 Assalamu Alaikum {username}\n\n📖 Welcome to the Quran Bot!\n\n✍️ For Quran verses in text:\n\n/surah <number> — Enter Surah number\n/juz <number> — Enter Juz' number\n/ayah <surah:ayah> — A verse or range (e.g. 2:255 or 2:1-10)\n/search <words> — Search the Quran\n\n🔊 For Audio (Full Surah Recitations):\n/abdulbasit <number> �️\n/yasser <number> 🎧\n\n⚙️ Other Commands:\n🌐 /language — To change language\n🆘 /support <message> — Send a message to the admin for help",
         "language_prompt": "Please select a language:",
         "language_selected": "✅ Language changed to English.",
         "support_prompt": "Please enter your message after the `/support` command.\nExample: `/support Hello, I need help`",
@@ -53,13 +167,24 @@ MESSAGES = {
         "join_button_text": "✅ Join Channel",
         "surah_prompt": "Please provide a valid Surah number (1-114).\nUsage: `/surah 2`",
         "juz_prompt": "Please provide a valid Juz' number (1-30).\nUsage: `/juz 15`",
+        "surah_header": "🕋 *Surah {number}: {name}*",
+        "juz_header": "📗 *Juz' {number}*",
+        "ayah_prompt": "Please provide a Surah and Ayah number.\nUsage: `/ayah 2:255` or `/ayah 2:1-10`",
+        "ayah_header": "📖 *{name} {reference}*",
+        "search_prompt": "Please enter the words to search for after the `/search` command.\nExample: `/search mercy`",
+        "search_results": "🔎 {query} — *{total}* results (page {page}/{pages})",
+        "search_no_results": "🔎 {query} — no results found.",
+        "search_expired": "This search has expired. Please send /search again.",
+        "search_unavailable": "Sorry, search is not available right now.",
+        "rate_limited": "⏳ You are sending commands too quickly. Please wait a moment and try again.",
         "reciter_prompt": "Please enter the Surah number after the reciter's name (1-114).\nUsage: `/{reciter_key} 2`",
         "audio_link_message": "🎧 *{reciter_name}*\n📖 *Surah {surah_name}*\n\n🔗 [Download / Play Audio Here]({audio_url})\n\nYou can listen or download the audio by clicking the blue link above.",
+        "audio_caption": "🎧 *{reciter_name}*\n📖 *Surah {surah_name}*",
         "error_fetching_audio": "Sorry, I could not get the audio link.\n\n**Reason:** The audio file was not found on the server (404 Error).\n**Attempted Link:** `{full_audio_url}`",
         "generic_error": "❌ An error occurred. Please try again later. If the problem persists, contact the admin."
     },
     'ar': {
-        "welcome": "🕌 السلام عليكم {username}\n\n📖 أهلاً بك في بوت القرآن!\n\n✍️ لآيات القرآن كنص:\n\n/surah <رقم> — أدخل رقم السورة\n/juz <رقم> — أدخل رقم الجزء\n\n🔊 للصوت (تلاوات السور كاملة):\n/abdulbasit <رقم> 🎙️\n/yasser <رقم> 🎧\n\n⚙️ أوامر أخرى:\n🌐 /language — لتغيير اللغة\n🆘 /support <رسالة> — أرسل رسالة إلى المسؤول للمساعدة",
+        "welcome": "🕌 السلام عليكم {username}\n\n📖 أهلاً بك في بوت القرآن!\n\n✍️ لآيات القرآن كنص:\n\n/surah <رقم> — أدخل رقم السورة\n/juz <رقم> — أدخل رقم الجزء\n/ayah <سورة:آية> — آية أو مجموعة آيات (مثال 2:255 أو 2:1-10)\n/search <كلمات> — ابحث في القرآن\n\n🔊 للصوت (تلاوات السور كاملة):\n/abdulbasit <رقم> 🎙️\n/yasser <رقم> 🎧\n\n⚙️ أوامر أخرى:\n🌐 /language — لتغيير اللغة\n🆘 /support <رسالة> — أرسل رسالة إلى المسؤول للمساعدة",
         "language_prompt": "الرجاء اختيار اللغة:",
         "language_selected": "✅ تم تغيير اللغة إلى العربية.",
         "support_prompt": "الرجاء إدخال رسالتك بعد أمر `/support`.\nمثال: `/support مرحباً، أحتاج إلى مساعدة`",
@@ -68,13 +193,24 @@ MESSAGES = {
         "join_button_text": "✅ انضم إلى القناة",
         "surah_prompt": "الرجاء إدخال رقم سورة صحيح (1-114).\nمثال: `/surah 2`",
         "juz_prompt": "الرجاء إدخال رقم جزء صحيح (1-30).\nمثال: `/juz 15`",
+        "surah_header": "🕋 *سورة {number}: {name}*",
+        "juz_header": "📗 *الجزء {number}*",
+        "ayah_prompt": "الرجاء إدخال رقم السورة والآية.\nمثال: `/ayah 2:255` أو `/ayah 2:1-10`",
+        "ayah_header": "📖 *{name} {reference}*",
+        "search_prompt": "الرجاء إدخال الكلمات المراد البحث عنها بعد أمر `/search`.\nمثال: `/search الرحمن`",
+        "search_results": "🔎 {query} — *{total}* نتيجة (صفحة {page}/{pages})",
+        "search_no_results": "🔎 {query} — لا توجد نتائج.",
+        "search_expired": "انتهت صلاحية هذا البحث. يرجى إرسال /search مرة أخرى.",
+        "search_unavailable": "عذراً، البحث غير متاح حالياً.",
+        "rate_limited": "⏳ أنت ترسل الأوامر بسرعة كبيرة. يرجى الانتظار قليلاً ثم المحاولة مرة أخرى.",
         "reciter_prompt": "الرجاء إدخال رقم السورة بعد اسم القارئ (1-114).\nمثال: `/{reciter_key} 2`",
         "audio_link_message": "🎧 *{reciter_name}*\n📖 *سورة {surah_name}*\n\n🔗 [تحميل / تشغيل الصوت هنا]({audio_url})\n\nيمكنك الاستماع أو تحميل الصوت بالضغط على الرابط الأزرق أعلاه.",
+        "audio_caption": "🎧 *{reciter_name}*\n📖 *سورة {surah_name}*",
         "error_fetching_audio": "عذراً، لم أتمكن من جلب رابط الملف الصوتي.\n\n**السبب:** لم يتم العثور على الملف الصوتي على الخادم (خطأ 404).\n**الرابط الذي تمت تجربته:** `{full_audio_url}`",
         "generic_error": "❌ حدث خطأ. يرجى المحاولة مرة أخرى في وقت لاحق. إذا استمرت المشكلة، اتصل بالمسؤول."
     },
     'tr': {
-        "welcome": "🕌 Esselamu aleyküm {username}\n\n📖 Kuran Bot'a hoş geldiniz!\n\n✍️ Metin olarak Kur'an ayetleri için:\n\n/surah <numara> — Sure numarasını girin\n/juz <numara> — Cüz numarasını girin\n\n🔊 Ses İçin (Tam Sure Tilavetleri):\n/abdulbasit <numara> 🎙️\n/yasser <numara> 🎧\n\n⚙️ Diğer Komutlar:\n🌐 /language — Dili değiştirmek için\n🆘 /support <mesaj> — Yardım için yöneticiye mesaj gönderin",
+        "welcome": "🕌 Esselamu aleyküm {username}\n\n📖 Kuran Bot'a hoş geldiniz!\n\n✍️ Metin olarak Kur'an ayetleri için:\n\n/surah <numara> — Sure numarasını girin\n/juz <numara> — Cüz numarasını girin\n/ayah <sure:ayet> — Bir ayet veya ayet aralığı (örn. 2:255 veya 2:1-10)\n/search <kelimeler> — Kur'an'da arama yapın\n\n🔊 Ses İçin (Tam Sure Tilavetleri):\n/abdulbasit <numara> 🎙️\n/yasser <numara> 🎧\n\n⚙️ Diğer Komutlar:\n🌐 /language — Dili değiştirmek için\n🆘 /support <mesaj> — Yardım için yöneticiye mesaj gönderin",
         "language_prompt": "Lütfen bir dil seçin:",
         "language_selected": "✅ Dil Türkçe olarak değiştirildi.",
         "support_prompt": "Lütfen mesajınızı `/support` komutundan sonra girin.\nÖrnek: `/support Merhaba, yardıma ihtiyacım var`",
@@ -83,16 +219,418 @@ MESSAGES = {
         "join_button_text": "✅ Kanala Katıl",
         "surah_prompt": "Lütfen geçerli bir Sure numarası girin (1-114).\nKullanım: `/surah 2`",
         "juz_prompt": "Lütfen geçerli bir Cüz numarası girin (1-30).\nKullanım: `/juz 15`",
+        "surah_header": "🕋 *Sure {number}: {name}*",
+        "juz_header": "📗 *Cüz {number}*",
+        "ayah_prompt": "Lütfen Sure ve Ayet numarasını girin.\nKullanım: `/ayah 2:255` veya `/ayah 2:1-10`",
+        "ayah_header": "📖 *{name} {reference}*",
+        "search_prompt": "Lütfen aranacak kelimeleri `/search` komutundan sonra girin.\nÖrnek: `/search rahmet`",
+        "search_results": "🔎 {query} — *{total}* sonuç (sayfa {page}/{pages})",
+        "search_no_results": "🔎 {query} — sonuç bulunamadı.",
+        "search_expired": "Bu aramanın süresi doldu. Lütfen /search komutunu tekrar gönderin.",
+        "search_unavailable": "Üzgünüz, arama şu anda kullanılamıyor.",
+        "rate_limited": "⏳ Çok hızlı komut gönderiyorsunuz. Lütfen biraz bekleyip tekrar deneyin.",
         "reciter_prompt": "Lütfen okuyucunun adından sonra Sure numarasını girin (1-114).\nKullanım: `/{reciter_key} 2`",
         "audio_link_message": "🎧 *{reciter_name}*\n📖 *Sure {surah_name}*\n\n🔗 [Sesi İndir / Oynat]({audio_url})\n\nYukarıdaki mavi bağlantıya tıklayarak sesi dinleyebilir veya indirebilirsiniz.",
+        "audio_caption": "🎧 *{reciter_name}*\n📖 *Sure {surah_name}*",
         "error_fetching_audio": "Üzgünüm, ses bağlantısını alamadım.\n\n**Neden:** Ses dosyası sunucuda bulunamadı (404 Hatası).\n**Denenen Bağlantı:** `{full_audio_url}`",
         "generic_error": "❌ Bir hata oluştu. Lütfen daha sonra tekrar deneyin. Sorun devam ederse, yöneticiyle iletişime geçin."
     }
 }
+MESSAGES = MappingProxyType({lang: MappingProxyType(texts) for lang, texts in MESSAGES.items()})
+LANGUAGE_KEYBOARD = {"inline_keyboard": [[{"text": "አማርኛ", "callback_data": "set_lang_am"}, {"text": "English", "callback_data": "set_lang_en"}], [{"text": "العربية", "callback_data": "set_lang_ar"}, {"text": "Türkçe", "callback_data": "set_lang_tr"}]]}
+
+
+# --- Surah Metadata ---
+# (englishName, number of ayahs, revelationType) for surahs 1-114, as named by alquran.cloud.
+SURAH_META = (
+    ('Al-Faatiha', 7, 'Meccan'),
+    ('Al-Baqara', 286, 'Medinan'),
+    ('Aal-i-Imraan', 200, 'Medinan'),
+    ('An-Nisaa', 176, 'Medinan'),
+    ('Al-Maaida', 120, 'Medinan'),
+    ("Al-An'aam", 165, 'Meccan'),
+    ("Al-A'raaf", 206, 'Meccan'),
+    ('Al-Anfaal', 75, 'Medinan'),
+    ('At-Tawba', 129, 'Medinan'),
+    ('Yunus', 109, 'Meccan'),
+    ('Hud', 123, 'Meccan'),
+    ('Yusuf', 111, 'Meccan'),
+    ("Ar-Ra'd", 43, 'Medinan'),
+    ('Ibrahim', 52, 'Meccan'),
+    ('Al-Hijr', 99, 'Meccan'),
+    ('An-Nahl', 128, 'Meccan'),
+    ('Al-Israa', 111, 'Meccan'),
+    ('Al-Kahf', 110, 'Meccan'),
+    ('Maryam', 98, 'Meccan'),
+    ('Taa-Haa', 135, 'Meccan'),
+    ('Al-Anbiyaa', 112, 'Meccan'),
+    ('Al-Hajj', 78, 'Medinan'),
+    ('Al-Muminoon', 118, 'Meccan'),
+    ('An-Noor', 64, 'Medinan'),
+    ('Al-Furqaan', 77, 'Meccan'),
+    ("Ash-Shu'araa", 227, 'Meccan'),
+    ('An-Naml', 93, 'Meccan'),
+    ('Al-Qasas', 88, 'Meccan'),
+    ('Al-Ankaboot', 69, 'Meccan'),
+    ('Ar-Room', 60, 'Meccan'),
+    ('Luqman', 34, 'Meccan'),
+    ('As-Sajda', 30, 'Meccan'),
+    ('Al-Ahzaab', 73, 'Medinan'),
+    ('Saba', 54, 'Meccan'),
+    ('Faatir', 45, 'Meccan'),
+    ('Yaseen', 83, 'Meccan'),
+    ('As-Saaffaat', 182, 'Meccan'),
+    ('Saad', 88, 'Meccan'),
+    ('Az-Zumar', 75, 'Meccan'),
+    ('Ghafir', 85, 'Meccan'),
+    ('Fussilat', 54, 'Meccan'),
+    ('Ash-Shura', 53, 'Meccan'),
+    ('Az-Zukhruf', 89, 'Meccan'),
+    ('Ad-Dukhaan', 59, 'Meccan'),
+    ('Al-Jaathiya', 37, 'Meccan'),
+    ('Al-Ahqaf', 35, 'Meccan'),
+    ('Muhammad', 38, 'Medinan'),
+    ('Al-Fath', 29, 'Medinan'),
+    ('Al-Hujuraat', 18, 'Medinan'),
+    ('Qaaf', 45, 'Meccan'),
+    ('Adh-Dhaariyat', 60, 'Meccan'),
+    ('At-Tur', 49, 'Meccan'),
+    ('An-Najm', 62, 'Meccan'),
+    ('Al-Qamar', 55, 'Meccan'),
+    ('Ar-Rahmaan', 78, 'Medinan'),
+    ('Al-Waaqia', 96, 'Meccan'),
+    ('Al-Hadid', 29, 'Medinan'),
+    ('Al-Mujaadila', 22, 'Medinan'),
+    ('Al-Hashr', 24, 'Medinan'),
+    ('Al-Mumtahana', 13, 'Medinan'),
+    ('As-Saff', 14, 'Medinan'),
+    ("Al-Jumu'a", 11, 'Medinan'),
+    ('Al-Munaafiqoon', 11, 'Medinan'),
+    ('At-Taghaabun', 18, 'Medinan'),
+    ('At-Talaaq', 12, 'Medinan'),
+    ('At-Tahrim', 12, 'Medinan'),
+    ('Al-Mulk', 30, 'Meccan'),
+    ('Al-Qalam', 52, 'Meccan'),
+    ('Al-Haaqqa', 52, 'Meccan'),
+    ("Al-Ma'aarij", 44, 'Meccan'),
+    ('Nooh', 28, 'Meccan'),
+    ('Al-Jinn', 28, 'Meccan'),
+    ('Al-Muzzammil', 20, 'Meccan'),
+    ('Al-Muddaththir', 56, 'Meccan'),
+    ('Al-Qiyaama', 40, 'Meccan'),
+    ('Al-Insaan', 31, 'Medinan'),
+    ('Al-Mursalaat', 50, 'Meccan'),
+    ('An-Naba', 40, 'Meccan'),
+    ("An-Naazi'aat", 46, 'Meccan'),
+    ('Abasa', 42, 'Meccan'),
+    ('At-Takwir', 29, 'Meccan'),
+    ('Al-Infitaar', 19, 'Meccan'),
+    ('Al-Mutaffifin', 36, 'Meccan'),
+    ('Al-Inshiqaaq', 25, 'Meccan'),
+    ('Al-Burooj', 22, 'Meccan'),
+    ('At-Taariq', 17, 'Meccan'),
+    ("Al-A'laa", 19, 'Meccan'),
+    ('Al-Ghaashiya', 26, 'Meccan'),
+    ('Al-Fajr', 30, 'Meccan'),
+    ('Al-Balad', 20, 'Meccan'),
+    ('Ash-Shams', 15, 'Meccan'),
+    ('Al-Lail', 21, 'Meccan'),
+    ('Ad-Dhuhaa', 11, 'Meccan'),
+    ('Ash-Sharh', 8, 'Meccan'),
+    ('At-Tin', 8, 'Meccan'),
+    ('Al-Alaq', 19, 'Meccan'),
+    ('Al-Qadr', 5, 'Meccan'),
+    ('Al-Bayyina', 8, 'Medinan'),
+    ('Az-Zalzala', 8, 'Medinan'),
+    ('Al-Aadiyaat', 11, 'Meccan'),
+    ("Al-Qaari'a", 11, 'Meccan'),
+    ('At-Takaathur', 8, 'Meccan'),
+    ('Al-Asr', 3, 'Meccan'),
+    ('Al-Humaza', 9, 'Meccan'),
+    ('Al-Fil', 5, 'Meccan'),
+    ('Quraish', 4, 'Meccan'),
+    ("Al-Maa'un", 7, 'Meccan'),
+    ('Al-Kawthar', 3, 'Meccan'),
+    ('Al-Kaafiroon', 6, 'Meccan'),
+    ('An-Nasr', 3, 'Medinan'),
+    ('Al-Masad', 5, 'Meccan'),
+    ('Al-Ikhlaas', 4, 'Meccan'),
+    ('Al-Falaq', 5, 'Meccan'),
+    ('An-Naas', 6, 'Meccan'),
+)
+
+# Number of ayahs before each surah, so surah s, ayah n has global number SURAH_STARTS[s - 1] + n.
+SURAH_STARTS = tuple(sum(count for _, count, _ in SURAH_META[:i]) for i in range(len(SURAH_META)))
+
+def surah_meta(surah_number):
+    name, ayah_count, revelation_type = SURAH_META[surah_number - 1]
+    return {'englishName': name, 'numberOfAyahs': ayah_count, 'revelationType': revelation_type}
+
+def ayah_reference(number):
+    """Maps a global ayah number (1-6236) to (surah, numberInSurah)."""
+    surah_number = bisect_right(SURAH_STARTS, number - 1)
+    return surah_number, number - SURAH_STARTS[surah_number - 1]
+
+
+# --- HTTP Client ---
+# (connect, read) timeouts per endpoint. Endpoints are named "<upstream>/<name>";
+# unlisted endpoints use their upstream's entry.
+HTTP_TIMEOUTS = {
+    'telegram': (3.05, 10),
+    'telegram/getChatMember': (3.05, 5),
+    # Telegram downloads the file before replying. An upload started just inside
+    # SERVERLESS_TIME_BUDGET must still end before the function's 60 s maxDuration,
+    # so a slow one falls back to a link instead of the function being killed.
+    'telegram/sendAudio': (3.05, 15),
+    'jsonbin': (3.05, 10),
+    'alquran': (3.05, 10),
+    'quranicaudio': (3.05, 10),
+}
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT')
+
+class Histogram:
+    """Cumulative latency histogram in seconds, Prometheus-style buckets."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.BUCKETS) if value <= bound), len(self.BUCKETS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+upstream_latency = {}
+upstream_errors = {}
+_http_session = None
+_http_lock = threading.Lock()
+
+def get_http_session():
+    """Returns the process-wide keep-alive session, creating it on first use."""
+    global _http_session
+    if _http_session is None:
+        with _http_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+def upstream_snapshot():
+    """Returns copies of (upstream_latency, upstream_errors), safe to iterate while requests run."""
+    with _http_lock:
+        return dict(upstream_latency), dict(upstream_errors)
+
+def _record_upstream(upstream, elapsed, failed):
+    with _http_lock:
+        histogram = upstream_latency.setdefault(upstream, Histogram())
+        if failed:
+            upstream_errors[upstream] = upstream_errors.get(upstream, 0) + 1
+    histogram.observe(elapsed)
+
+def _retry_after(response):
+    """Seconds a 429 asks us to wait (Telegram's retry_after or the Retry-After header), or None."""
+    try:
+        retry_after = response.json().get('parameters', {}).get('retry_after')
+    except ValueError:
+        retry_after = None
+    retry_after = retry_after or response.headers.get('Retry-After')
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+def _retry_delay(attempt, response=None):
+    """Seconds to wait before retry `attempt`, or None if the response says not to retry."""
+    if response is not None and response.status_code == 429:
+        retry_after = _retry_after(response)
+        if retry_after is not None:
+            return retry_after if retry_after <= HTTP_RETRY_AFTER_MAX else None
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+def http_request(method, url, endpoint, retries=None, **kwargs):
+    """Sends a request over the shared session and returns the final response.
+
+    429s and connections that could not be established are retried for every
+    method; dropped connections, read timeouts and 5xx responses only for
+    idempotent ones, since a POST may already have been delivered. Errors are raised as
+    requests exceptions, HTTP error statuses are left to the caller.
+    """
+    with span('upstream'):
+        response = _http_request(method, url, endpoint, retries, **kwargs)
+    if response.status_code >= 400:
+        mark_trace_error()
+    return response
+
+def _never_sent(error):
+    """True if the request failed before a connection was established, so nothing reached the server."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    from urllib3.exceptions import NewConnectionError
+    return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+
+def _http_request(method, url, endpoint, retries, **kwargs):
+    upstream = endpoint.split('/')[0]
+    kwargs.setdefault('timeout', HTTP_TIMEOUTS.get(endpoint, HTTP_TIMEOUTS.get(upstream, 10)))
+    retries = HTTP_MAX_RETRIES if retries is None else retries
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            response = get_http_session().request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            _record_upstream(upstream, time.perf_counter() - started, True)
+            retryable = _never_sent(e) or (idempotent and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)))
+            if attempt >= retries or not retryable:
+                mark_trace_error()
+                raise
+            delay = _retry_delay(attempt)
+        else:
+            failed = response.status_code == 429 or response.status_code >= 500
+            _record_upstream(upstream, time.perf_counter() - started, failed)
+            if not failed or attempt >= retries or (response.status_code != 429 and not idempotent):
+                return response
+            delay = _retry_delay(attempt, response)
+            if delay is None:
+                return response
+        logging.warning(f"Retrying {method} {endpoint} in {delay:.2f}s (attempt {attempt + 1} of {retries})")
+        time.sleep(delay)
+
+
+# --- Instrumentation ---
+# Each update is traced on its worker thread. span() attributes wall time to a
+# phase (db, membership, upstream, send); only the outermost span counts, so an
+# HTTP call made while checking membership is billed to "membership".
+PHASES = ('db', 'membership', 'upstream', 'send')
+_trace = threading.local()
+
+class Trace:
+    def __init__(self):
+        self.name = None
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.error = False
+        self.active = False
+
+def begin_trace():
+    _trace.current = Trace()
+    return _trace.current
+
+def end_trace():
+    trace = getattr(_trace, 'current', None)
+    _trace.current = None
+    if trace is not None and trace.name:
+        command_metrics.record(trace.name, time.perf_counter() - trace.started, trace.phases, trace.error)
+
+def mark_trace_error():
+    trace = getattr(_trace, 'current', None)
+    if trace is not None:
+        trace.error = True
+
+@contextmanager
+def span(phase):
+    trace = getattr(_trace, 'current', None)
+    if trace is None or trace.active:
+        yield
+        return
+    trace.active = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.phases[phase] += time.perf_counter() - started
+        trace.active = False
+
+class CommandMetrics:
+    """Per-command call/error counters, latency histograms and a rolling window for percentiles."""
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed, phases, error):
+        with self._lock:
+            entry = self.commands.get(name)
+            if entry is None:
+                entry = self.commands[name] = {'calls': 0, 'errors': 0, 'latency': Histogram(),
+                                               'phases': dict.fromkeys(PHASES, 0.0), 'recent': deque(maxlen=5000)}
+            entry['calls'] += 1
+            entry['errors'] += bool(error)
+            for phase, seconds in phases.items():
+                entry['phases'][phase] += seconds
+            entry['recent'].append((time.monotonic(), elapsed))
+        entry['latency'].observe(elapsed)
+
+    def snapshot(self):
+        """Returns {name: {'calls', 'errors', 'latency', 'phases'}}, safe to iterate while commands run."""
+        with self._lock:
+            return {name: {'calls': entry['calls'], 'errors': entry['errors'], 'latency': entry['latency'],
+                           'phases': dict(entry['phases'])} for name, entry in self.commands.items()}
 
+    def percentiles(self, name, quantiles=(0.5, 0.95)):
+        """Returns (samples, [latency at each quantile]) over the rolling window."""
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            samples = sorted(elapsed for at, elapsed in self.commands[name]['recent'] if at >= cutoff)
+        if not samples:
+            return 0, [0.0 for _ in quantiles]
+        return len(samples), [samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles]
 
-# --- Database Functions (JSONBin.io) ---
-# DB Structure: {"users": {"user_id_1": {"lang": "en"}, "user_id_2": {"lang": "am"}}}
+command_metrics = CommandMetrics(STATS_WINDOW_SECONDS)
+
+def _prometheus_histogram(lines, metric, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(Histogram.BUCKETS + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_sum{{{labels}}} {histogram.sum:.6f}')
+    lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+
+def render_metrics():
+    """Prometheus text exposition of command, upstream and cache metrics."""
+    lines = ['# TYPE quranbot_command_calls_total counter', '# TYPE quranbot_command_errors_total counter',
+             '# TYPE quranbot_command_phase_seconds_total counter', '# TYPE quranbot_command_seconds histogram']
+    for name, entry in sorted(command_metrics.snapshot().items()):
+        labels = f'command="{name}"'
+        lines.append(f'quranbot_command_calls_total{{{labels}}} {entry["calls"]}')
+        lines.append(f'quranbot_command_errors_total{{{labels}}} {entry["errors"]}')
+        for phase, seconds in entry['phases'].items():
+            lines.append(f'quranbot_command_phase_seconds_total{{{labels},phase="{phase}"}} {seconds:.6f}')
+        _prometheus_histogram(lines, 'quranbot_command_seconds', labels, entry['latency'])
+    lines += ['# TYPE quranbot_upstream_errors_total counter', '# TYPE quranbot_upstream_seconds histogram']
+    latency, errors = upstream_snapshot()
+    for name, histogram in sorted(latency.items()):
+        lines.append(f'quranbot_upstream_errors_total{{upstream="{name}"}} {errors.get(name, 0)}')
+        _prometheus_histogram(lines, 'quranbot_upstream_seconds', f'upstream="{name}"', histogram)
+    lines.append('# TYPE quranbot_cache_hits_total counter')
+    lines.append('# TYPE quranbot_cache_misses_total counter')
+    for name, cache in (('membership', membership_cache), ('render', render_cache)):
+        lines.append(f'quranbot_cache_hits_total{{cache="{name}"}} {cache.hits}')
+        lines.append(f'quranbot_cache_misses_total{{cache="{name}"}} {cache.misses}')
+    for key, value in lang_writes.stats().items():
+        lines.append(f'quranbot_lang_writes_{key} {value}')
+    for key, value in updates.stats().items():
+        lines.append(f'quranbot_updates_{key}_total {value}')
+    lines.append(f'quranbot_updates_throttled_total {flood_control.throttled}')
+    lines.append(f'quranbot_throttle_notices_total {flood_control.notices}')
+    flights = inflight.stats()
+    lines.append(f'quranbot_singleflight_calls_total {flights["calls"]}')
+    lines.append(f'quranbot_singleflight_shared_total {flights["shared"]}')
+    return "\n".join(lines) + "\n"
+
+
+# --- JSONBin.io Functions ---
+# DB Structure: {"users": {"user_id_1": {"lang": "en"}, "user_id_2": {"lang": "am", "blocked": true}}, "meta": {...}}
 def get_db():
     """Fetches the entire database from JSONBin.io."""
     if not all([JSONBIN_BIN_ID, JSONBIN_API_KEY]):
@@ -100,7 +638,7 @@ def get_db():
         raise ValueError("JSONBin configuration is incomplete.")
     headers = {'X-Master-Key': JSONBIN_API_KEY, 'X-Bin-Meta': 'false'}
     try:
-        req = requests.get(f'https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}', headers=headers, timeout=10)
+        req = http_request('GET', f'https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}', 'jsonbin/read', headers=headers)
         req.raise_for_status()
         return req.json()
     except requests.exceptions.RequestException as e:
@@ -114,33 +652,637 @@ def update_db(data):
         raise ValueError("JSONBin configuration is incomplete.")
     headers = {'Content-Type': 'application/json', 'X-Master-Key': JSONBIN_API_KEY}
     try:
-        req = requests.put(f'https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}', json=data, headers=headers, timeout=10)
+        req = http_request('PUT', f'https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}', 'jsonbin/update', json=data, headers=headers)
         req.raise_for_status()
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to update DB on JSONBin: {e}")
         raise
 
+# --- User Storage Backends ---
+DEFAULT_LANG = 'am'
+
+class StorageBackend:
+    """Per-user storage. Users are keyed by their Telegram id as a string."""
+
+    def get_user(self, user_id):
+        """Returns the user's record, e.g. {'lang': 'en'}, or None if unknown."""
+        raise NotImplementedError
+
+    def set_user_lang(self, user_id, lang_code):
+        raise NotImplementedError
+
+    def set_many(self, langs):
+        """Writes a {user_id: lang_code} mapping in one go where the backend allows it."""
+        for user_id, lang_code in langs.items():
+            self.set_user_lang(user_id, lang_code)
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def user_ids(self, active_only=False):
+        """Returns every known user id in ascending order, optionally skipping users who blocked the bot."""
+        raise NotImplementedError
+
+    def mark_blocked(self, user_id):
+        """Flags a user who blocked the bot. Setting their language again clears it."""
+        raise NotImplementedError
+
+    def mark_blocked_many(self, user_ids):
+        """Flags several users in one go where the backend allows it."""
+        for user_id in user_ids:
+            self.mark_blocked(user_id)
+
+    def get_meta(self, key):
+        """Returns a JSON value stored under `key`, or None."""
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        raise NotImplementedError
+
+    def update_meta(self, key, update):
+        """Replaces the value under `key` with update(current value or None) and returns it."""
+        value = update(self.get_meta(key))
+        self.set_meta(key, value)
+        return value
+
+    def import_users(self, users):
+        """Bulk-loads a {"user_id": {"lang": ...}} mapping."""
+        for user_id, record in users.items():
+            self.set_user_lang(user_id, record.get('lang', DEFAULT_LANG))
+
+class SQLiteBackend(StorageBackend):
+    """Embedded SQLite store in WAL mode, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, lang TEXT NOT NULL, blocked INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+            if 'blocked' not in [row[1] for row in conn.execute("PRAGMA table_info(users)")]:
+                conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_user(self, user_id):
+        row = self._conn().execute("SELECT lang FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return {'lang': row[0]} if row else None
+
+    def set_user_lang(self, user_id, lang_code):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO users (user_id, lang) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET lang = excluded.lang, blocked = 0", (str(user_id), lang_code))
+
+    def count_users(self):
+        return self._conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def user_ids(self, active_only=False):
+        query = "SELECT user_id FROM users WHERE blocked = 0 ORDER BY user_id" if active_only else "SELECT user_id FROM users ORDER BY user_id"
+        return [row[0] for row in self._conn().execute(query)]
+
+    def mark_blocked(self, user_id):
+        self.mark_blocked_many([user_id])
+
+    def mark_blocked_many(self, user_ids):
+        with self._conn() as conn:
+            conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(str(user_id),) for user_id in user_ids])
+
+    def get_meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+
+    def update_meta(self, key, update):
+        conn = self._conn()
+        with conn:
+            # Take the write lock before reading so concurrent writers cannot interleave.
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            value = update(json.loads(row[0]) if row else None)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+        return value
+
+    def set_many(self, langs):
+        rows = [(str(user_id), lang_code) for user_id, lang_code in langs.items()]
+        with self._conn() as conn:
+            conn.executemany("INSERT INTO users (user_id, lang) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET lang = excluded.lang, blocked = 0", rows)
+
+    def import_users(self, users):
+        self.set_many({user_id: record.get('lang', DEFAULT_LANG) for user_id, record in users.items()})
+
+class JsonBinBackend(StorageBackend):
+    """Adapter over the single JSONBin document.
+
+    JSONBin has no point reads, so the document is cached for a few seconds and
+    writes are serialized in-process to avoid losing concurrent updates.
+    """
+
+    def __init__(self, cache_seconds=5):
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._fetched_at = 0.0
+
+    def _users(self, fresh=False):
+        if fresh or self._snapshot is None or time.monotonic() - self._fetched_at > self.cache_seconds:
+            self._snapshot = get_db()
+            self._fetched_at = time.monotonic()
+        return self._snapshot.setdefault('users', {})
+
+    def get_user(self, user_id):
+        return self._users().get(str(user_id))
+
+    def set_user_lang(self, user_id, lang_code):
+        with self._lock:
+            self._users(fresh=True)[str(user_id)] = {'lang': lang_code}
+            update_db(self._snapshot)
+
+    def set_many(self, langs):
+        with self._lock:
+            users = self._users(fresh=True)
+            for user_id, lang_code in langs.items():
+                users[str(user_id)] = {'lang': lang_code}
+            update_db(self._snapshot)
+
+    def count_users(self):
+        # No server-side count: this is len() of the (briefly cached) document.
+        return len(self._users())
+
+    def user_ids(self, active_only=False):
+        return sorted(user_id for user_id, record in self._users().items() if not (active_only and record.get('blocked')))
+
+    def mark_blocked(self, user_id):
+        self.mark_blocked_many([user_id])
+
+    def mark_blocked_many(self, user_ids):
+        with self._lock:
+            users = self._users(fresh=True)
+            records = [users[str(user_id)] for user_id in user_ids if str(user_id) in users]
+            if records:
+                for record in records:
+                    record['blocked'] = True
+                update_db(self._snapshot)
+
+    def get_meta(self, key):
+        self._users()
+        return self._snapshot.get('meta', {}).get(key)
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._users(fresh=True)
+            self._snapshot.setdefault('meta', {})[key] = value
+            update_db(self._snapshot)
+
+    def update_meta(self, key, update):
+        with self._lock:
+            self._users(fresh=True)
+            meta = self._snapshot.setdefault('meta', {})
+            value = meta[key] = update(meta.get(key))
+            update_db(self._snapshot)
+        return value
+
+    def import_users(self, users):
+        with self._lock:
+            self._users(fresh=True).update({str(k): v for k, v in users.items()})
+            update_db(self._snapshot)
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Returns the configured storage backend, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = JsonBinBackend() if USER_STORE == 'jsonbin' else SQLiteBackend(USER_DB_PATH)
+    return _store
+
+_cache_store = None
+
+def get_cache_store():
+    """Returns the SQLite store for derived caches, shared with the user store when that is the same file."""
+    global _cache_store
+    if USER_STORE != 'jsonbin' and CACHE_DB_PATH == USER_DB_PATH:
+        return get_store()
+    if _cache_store is None:
+        with _store_lock:
+            if _cache_store is None:
+                _cache_store = SQLiteBackend(CACHE_DB_PATH)
+    return _cache_store
+
+class LangWriteBuffer:
+    """Write-behind buffer for language updates.
+
+    No-op writes are dropped, repeated updates for the same user are coalesced,
+    and pending updates are written with one set_many() call once the batch is
+    full or old enough, at the end of every update and request, or at exit.
+    Updates handled concurrently by other workers share that write.
+    """
+
+    def __init__(self, batch_size, flush_seconds):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.updates = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    def pending_lang(self, user_id):
+        return self._pending.get(str(user_id))
+
+    def set(self, user_id, lang_code):
+        """Queues a language update. Returns False if it was a no-op."""
+        user_id = str(user_id)
+        with self._lock:
+            self.updates += 1
+            pending = self._pending.get(user_id)
+        if pending is None:
+            stored = get_store().get_user(user_id)
+            pending = stored and stored.get('lang')
+        with self._lock:
+            if pending == lang_code:
+                self.skipped += 1
+                return False
+            if user_id in self._pending:
+                self.coalesced += 1
+            elif not self._pending:
+                self._oldest = time.monotonic()
+            self._pending[user_id] = lang_code
+        self.flush(force=False)
+        return True
+
+    def _due(self):
+        return len(self._pending) >= self.batch_size or time.monotonic() - self._oldest >= self.flush_seconds
+
+    def flush(self, force=True):
+        """Writes pending updates. Unless forced, only when a threshold is reached."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending or not (force or self._due()):
+                    return 0
+                batch, self._pending = self._pending, {}
+            started = time.perf_counter()
+            try:
+                get_store().set_many(batch)
+            except Exception as e:
+                logging.error(f"Failed to flush {len(batch)} language updates: {e}")
+                with self._lock:
+                    self.failed_flushes += 1
+                    for user_id, lang_code in batch.items():
+                        self._pending.setdefault(user_id, lang_code)
+                    self._oldest = time.monotonic()
+                return 0
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.flushes += 1
+                self.rows_written += len(batch)
+                self.flush_seconds_total += elapsed
+                self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+            logging.info(f"Flushed {len(batch)} language updates in {elapsed * 1000:.1f} ms")
+            return len(batch)
+
+    def stats(self):
+        written = self.updates - self.skipped
+        return {
+            'updates': self.updates,
+            'skipped': self.skipped,
+            'coalesced': self.coalesced,
+            'pending': len(self._pending),
+            'rows_written': self.rows_written,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'coalescing_ratio': written / self.rows_written if self.rows_written else 0.0,
+            'flush_ms_avg': self.flush_seconds_total * 1000 / self.flushes if self.flushes else 0.0,
+            'flush_ms_max': self.flush_seconds_max * 1000,
+        }
+
+lang_writes = LangWriteBuffer(USER_WRITE_BATCH_SIZE, USER_WRITE_FLUSH_SECONDS)
+atexit.register(lang_writes.flush)
+
+@app.teardown_request
+def flush_lang_writes(exc=None):
+    # Another instance may serve this user next, and a frozen serverless
+    # instance never reaches atexit, so nothing is left pending.
+    lang_writes.flush()
+
 def get_user_data(user_id):
     """Gets specific user's data from the DB, or returns a default."""
+    pending = lang_writes.pending_lang(user_id)
+    if pending:
+        return {'lang': pending}
     try:
-        db_data = get_db()
-        return db_data.get('users', {}).get(str(user_id), {'lang': 'am'}) # Default to Amharic
+        with span('db'):
+            return get_store().get_user(user_id) or {'lang': DEFAULT_LANG}
     except Exception:
-        return {'lang': 'am'}
+        mark_trace_error()
+        return {'lang': DEFAULT_LANG}
 
 def set_user_lang(user_id, lang_code):
-    """Adds a user or updates their language in the database."""
+    """Adds a user or updates their language in the database (write-behind)."""
     try:
-        db_data = get_db()
-        if 'users' not in db_data:
-            db_data['users'] = {}
-        db_data['users'][str(user_id)] = {'lang': lang_code}
-        update_db(db_data)
-        logging.info(f"Set language for user {user_id} to {lang_code}")
+        with span('db'):
+            queued = lang_writes.set(user_id, lang_code)
+        if queued:
+            logging.info(f"Queued language {lang_code} for user {user_id}")
     except Exception as e:
+        mark_trace_error()
         logging.error(f"Failed to set language for user {user_id}: {e}")
 
 
+# --- Caches ---
+class TTLCache:
+    """Bounded, thread-safe LRU cache with a per-entry time to live."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else float('inf')
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def peek(self, key, default=None):
+        """Like get(), but neither counts as a lookup nor refreshes recency."""
+        item = self._data.get(key)
+        return default if item is None or item[1] <= time.monotonic() else item[0]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+_DELETED = object()
+
+class PersistentDict:
+    """Small dict stored as one JSON value under a meta key of the cache store, loaded on first use.
+
+    Other instances write the same key, so save() merges this process's changes
+    into the stored value instead of overwriting it with a stale snapshot. If
+    `seed_path` names a JSON file shipped with the deployment, its entries are
+    used wherever the store has none.
+    """
+
+    def __init__(self, key, seed_path=None):
+        self.key = key
+        self.seed_path = seed_path
+        self._data = None
+        self._changes = {}
+        self._lock = threading.RLock()
+
+    def _seed(self):
+        if not self.seed_path:
+            return {}
+        try:
+            with open(self.seed_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read {self.seed_path}: {e}")
+            return {}
+
+    def _items(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    try:
+                        self._data = {**self._seed(), **(get_cache_store().get_meta(self.key) or {})}
+                    except Exception as e:
+                        logging.error(f"Could not load {self.key}: {e}")
+                        return {}
+        return self._data
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._items())
+
+    def get(self, key, default=None):
+        return self._items().get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._items()[key] = value
+            self._changes[key] = value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._changes[key] = _DELETED
+            return self._items().pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._items()
+
+    def __len__(self):
+        return len(self._items())
+
+    def save(self):
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return
+
+        def merge(stored):
+            merged = dict(stored or {})
+            for key, value in changes.items():
+                if value is _DELETED:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+            return merged
+
+        try:
+            merged = get_cache_store().update_meta(self.key, merge)
+        except Exception:
+            with self._lock:
+                self._changes = {**changes, **self._changes}
+            raise
+        with self._lock:
+            # Adopt entries saved by other instances, keeping changes made meanwhile.
+            self._data = merged
+            for key, value in self._changes.items():
+                if value is _DELETED:
+                    self._data.pop(key, None)
+                else:
+                    self._data[key] = value
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    Callers that arrive while a call is in flight wait for it and get its
+    result (or exception) instead of repeating the work.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args):
+        """Returns (result, shared); shared is True if another caller did the work."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._calls)}
+
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE)
+# Upstream fetches, renders and audio uploads currently running, keyed by what they produce.
+inflight = SingleFlight()
+
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Withholds tokens for `seconds`, e.g. after a 429 with retry_after."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class FloodControl:
+    """Per-user token buckets for incoming commands, with one notice per throttle window."""
+
+    def __init__(self, rate_per_minute, burst, notice_seconds, maxsize=50000):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        # An evicted or expired bucket would have refilled by now anyway.
+        self._buckets = TTLCache(maxsize, ttl=max(600, burst / self.rate) if self.rate > 0 else None)
+        self._notices = TTLCache(maxsize, ttl=notice_seconds)
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.notices = 0
+
+    def allow(self, user_id):
+        """Takes a token for the user. Returns False if they are over their limit."""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            bucket = self._buckets.peek(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets.set(user_id, bucket)
+        if bucket.try_acquire():
+            return True
+        self.throttled += 1
+        return False
+
+    def should_notify(self, user_id):
+        """True the first time a user is throttled within the notice window."""
+        with self._lock:
+            if self._notices.peek(user_id):
+                return False
+            self._notices.set(user_id, True)
+            self.notices += 1
+            return True
+
+    def stats(self):
+        return {'throttled': self.throttled, 'notices': self.notices, 'tracked_users': len(self._buckets)}
+
+flood_control = FloodControl(USER_RATE_PER_MINUTE, USER_RATE_BURST, USER_THROTTLE_NOTICE_SECONDS)
+
+
 # --- Telegram API Functions ---
 def send_telegram_message(chat_id, text, parse_mode="Markdown", reply_markup=None):
     """Sends a message via the Telegram Bot API."""
@@ -149,26 +1291,570 @@ def send_telegram_message(chat_id, text, parse_mode="Markdown", reply_markup=Non
     if reply_markup:
         payload['reply_markup'] = json.dumps(reply_markup)
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        with span('send'):
+            response = http_request('POST', url, 'telegram/sendMessage', json=payload)
         response.raise_for_status()
         logging.info(f"Message sent to chat_id: {chat_id}")
     except requests.exceptions.RequestException as e:
         logging.error(f"Failed to send message to {chat_id}: {e}")
 
+def call_telegram(method, payload):
+    """Calls a Bot API method and returns the decoded reply ({'ok': ..., ...})."""
+    url = f"https://api.telegram.org/bot{TOKEN}/{method}"
+    with span('send'):
+        response = http_request('POST', url, f"telegram/{method}", json=payload)
+    try:
+        return response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise
+
 def is_user_member(user_id):
-    """Checks if a user is a member of the specified channel."""
+    """Checks if a user is a member of the specified channel (cached)."""
     if not CHANNEL_ID:
         return True
+    cached = membership_cache.get(str(user_id))
+    if cached is not None:
+        return cached
     try:
         url = f"https://api.telegram.org/bot{TOKEN}/getChatMember"
         payload = {'chat_id': CHANNEL_ID, 'user_id': user_id}
-        response = requests.get(url, params=payload, timeout=5)
+        with span('membership'):
+            response = http_request('GET', url, 'telegram/getChatMember', params=payload)
         response.raise_for_status()
         status = response.json().get('result', {}).get('status')
-        return status in ['creator', 'administrator', 'member']
+        is_member = status in ['creator', 'administrator', 'member']
     except requests.exceptions.RequestException as e:
         logging.error(f"Could not check membership for user {user_id}: {e}")
         return False
+    membership_cache.set(str(user_id), is_member, MEMBERSHIP_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL)
+    return is_member
+
+def invalidate_membership(user_id=None):
+    """Drops the cached membership answer for one user, or for everyone."""
+    if user_id is None:
+        membership_cache.clear()
+    else:
+        membership_cache.pop(str(user_id))
+
+
+# --- Quran Text Corpus ---
+# Layout of CORPUS_DIR (generated by scripts/build_corpus.py):
+#   quran-index.json  surah metadata plus first-ayah tables for surahs, juz and pages
+#   <edition>.txt     every ayah of the edition, UTF-8, packed back to back
+#   <edition>.off     TOTAL_AYAHS + 1 little-endian uint32 byte offsets into <edition>.txt
+# Ayahs are addressed by their global number (1-6236); ayah n spans off[n-1]:off[n].
+TOTAL_AYAHS = 6236
+CORPUS_INDEX_FILE = 'quran-index.json'
+
+def corpus_paths(edition):
+    """Returns the (text, offsets) file paths of a bundled edition."""
+    return os.path.join(CORPUS_DIR, f"{edition}.txt"), os.path.join(CORPUS_DIR, f"{edition}.off")
+
+class QuranCorpus:
+    """Read-only, memory-mapped view over one bundled edition."""
+
+    def __init__(self, edition, index, text_path, offsets_path):
+        self.edition = edition
+        self.index = index
+        self.surahs = index['surahs']
+        self.juz_start = index['juz_start']
+        self.page_start = index['page_start']
+        with open(offsets_path, 'rb') as f:
+            self.offsets = array('I', f.read())
+        if sys.byteorder == 'big':
+            self.offsets.byteswap()
+        if len(self.offsets) != TOTAL_AYAHS + 1:
+            raise ValueError(f"Corrupt offset table for edition {edition}")
+        with open(text_path, 'rb') as f:
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def ayah_text(self, number):
+        """Text of the ayah with the given global number (1-6236)."""
+        return self.blob[self.offsets[number - 1]:self.offsets[number]].decode('utf-8')
+
+    def surah_of(self, number):
+        """Surah number (1-114) containing the given global ayah number."""
+        lo, hi = 0, len(self.surahs) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.surahs[mid]['start'] < number: lo = mid
+            else: hi = mid - 1
+        return lo + 1
+
+    def _ayahs(self, first, last):
+        """Yields (surah_number, number_in_surah, text) for global ayahs first..last."""
+        surah = self.surah_of(first)
+        for number in range(first, last + 1):
+            while surah < len(self.surahs) and self.surahs[surah]['start'] < number:
+                surah += 1
+            yield surah, number - self.surahs[surah - 1]['start'], self.ayah_text(number)
+
+    def surah(self, surah_number):
+        info = self.surahs[surah_number - 1]
+        return info, list(self._ayahs(info['start'] + 1, info['start'] + info['count']))
+
+    def juz(self, juz_number):
+        return list(self._ayahs(self.juz_start[juz_number - 1] + 1, self.juz_start[juz_number]))
+
+    def page(self, page_number):
+        return list(self._ayahs(self.page_start[page_number - 1] + 1, self.page_start[page_number]))
+
+_corpus_cache = {}
+_corpus_lock = threading.Lock()
+
+def get_corpus(edition):
+    """Opens a bundled edition on first use. Returns None if it is not bundled."""
+    if edition in _corpus_cache:
+        return _corpus_cache[edition]
+    with _corpus_lock:
+        if edition not in _corpus_cache:
+            corpus = None
+            text_path, offsets_path = corpus_paths(edition)
+            index_path = os.path.join(CORPUS_DIR, CORPUS_INDEX_FILE)
+            if all(os.path.exists(p) for p in (text_path, offsets_path, index_path)):
+                try:
+                    with open(index_path, encoding='utf-8') as f:
+                        corpus = QuranCorpus(edition, json.load(f), text_path, offsets_path)
+                except (OSError, ValueError, KeyError) as e:
+                    logging.error(f"Could not open bundled corpus for {edition}: {e}")
+            if corpus is None and edition == QURAN_EDITION:
+                logging.warning(f"No bundled corpus for {edition} in {CORPUS_DIR}; using alquran.cloud and disabling /search. "
+                                f"Build it with scripts/build_corpus.py (vercel.json runs it on deploy).")
+            _corpus_cache[edition] = corpus
+    return _corpus_cache[edition]
+
+def fetch_quran_api(path, endpoint, params=None):
+    """GETs an alquran.cloud resource's data; concurrent identical requests share one fetch."""
+    def fetch():
+        response = http_request('GET', f"{QURAN_API_BASE_URL}{path}", endpoint, params=params)
+        response.raise_for_status()
+        return response.json()['data']
+    return inflight.do(('alquran', path, tuple(sorted((params or {}).items()))), fetch)[0]
+
+def fetch_surah(surah_number, edition=QURAN_EDITION):
+    """Returns (englishName, [(numberInSurah, text), ...]) from the corpus or the API."""
+    corpus = get_corpus(edition)
+    if corpus:
+        info, ayahs = corpus.surah(surah_number)
+        return info['englishName'], [(n, text) for _, n, text in ayahs]
+    data = fetch_quran_api(f"/surah/{surah_number}/{edition}", 'alquran/surah')
+    return data['englishName'], [(a['numberInSurah'], a['text']) for a in data['ayahs']]
+
+def fetch_ayahs(surah_number, first, last, edition=QURAN_EDITION):
+    """Returns [(numberInSurah, text), ...] for ayahs first..last of a surah."""
+    corpus = get_corpus(edition)
+    if corpus:
+        start = corpus.surahs[surah_number - 1]['start']
+        return [(n, corpus.ayah_text(start + n)) for n in range(first, last + 1)]
+    params = {'offset': first - 1, 'limit': last - first + 1}
+    data = fetch_quran_api(f"/surah/{surah_number}/{edition}", 'alquran/surah', params)
+    return [(a['numberInSurah'], a['text']) for a in data['ayahs']]
+
+def bundled_editions():
+    """Editions with a corpus in CORPUS_DIR, the default edition first."""
+    try:
+        editions = sorted(name[:-4] for name in os.listdir(CORPUS_DIR) if name.endswith('.off'))
+    except OSError:
+        return []
+    return sorted(editions, key=lambda edition: edition != QURAN_EDITION)
+
+def fetch_juz(juz_number, edition=QURAN_EDITION):
+    """Returns [(surah_name, numberInSurah, text), ...] from the corpus or the API."""
+    corpus = get_corpus(edition)
+    if corpus:
+        return [(corpus.surahs[s - 1]['name'], n, text) for s, n, text in corpus.juz(juz_number)]
+    data = fetch_quran_api(f"/juz/{juz_number}/{edition}", 'alquran/juz')
+    return [(a['surah']['name'], a['numberInSurah'], a['text']) for a in data['ayahs']]
+
+
+# --- Recitation Audio ---
+# Availability of (reciter, surah) files, persisted under one meta key as
+# {"<reciter_key>:<surah>": [http_status, checked_at_unix_time]}.
+# Seeded from AUDIO_STATUS_BUNDLE, written at deploy time by scripts/prewarm_audio.py --bundle.
+AUDIO_STATUS_BUNDLE = os.path.join(CORPUS_DIR, 'audio_status.json')
+audio_statuses = PersistentDict('audio_status', seed_path=AUDIO_STATUS_BUNDLE)
+# Telegram file_id per "<reciter_key>:<surah>"; '' marks files Telegram would not fetch.
+audio_file_ids = PersistentDict('audio_file_ids')
+_audio_lock = threading.Lock()
+_audio_verifying = set()
+# Bad Request descriptions meaning Telegram itself could not fetch the URL. Other
+# 400s (no rights to send audio in a group, caption errors) are about one chat.
+UNFETCHABLE_AUDIO_ERRORS = ('failed to get http url content', 'wrong file identifier/http url specified',
+                            'wrong type of the web page content')
+
+def audio_unfetchable(reply):
+    """True if a failed sendAudio reply means the recitation's URL can never be sent by Telegram."""
+    description = (reply.get('description') or '').lower()
+    return reply.get('error_code') == 400 and any(error in description for error in UNFETCHABLE_AUDIO_ERRORS)
+
+def audio_url(reciter_key, surah_number):
+    return f"https://download.quranicaudio.com/quran/{RECITERS[reciter_key]['identifier']}/{str(surah_number).zfill(3)}.mp3"
+
+def audio_status(reciter_key, surah_number):
+    """Returns (http_status or None, is_fresh) from the availability cache."""
+    entry = audio_statuses.get(f"{reciter_key}:{surah_number}")
+    if not entry:
+        return None, False
+    status, checked_at = entry
+    ttl = AUDIO_STATUS_TTL if status == 200 else AUDIO_MISSING_TTL
+    return status, time.time() - checked_at < ttl
+
+def check_audio(reciter_key, surah_number):
+    """HEADs the audio file and records definitive answers. Returns the HTTP status."""
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    response = http_request('HEAD', audio_url(reciter_key, surah_number), 'quranicaudio/head', headers=headers, allow_redirects=True)
+    if response.status_code == 200 or response.status_code in (403, 404, 410):
+        audio_statuses.set(f"{reciter_key}:{surah_number}", [response.status_code, int(time.time())])
+    return response.status_code
+
+def verify_audio_in_background(reciter_key, surah_number):
+    """Checks one file off the request path; concurrent requests for it share the check."""
+    key = f"{reciter_key}:{surah_number}"
+    with _audio_lock:
+        if key in _audio_verifying:
+            return
+        _audio_verifying.add(key)
+
+    def target():
+        try:
+            check_audio(reciter_key, surah_number)
+            audio_statuses.save()
+        except Exception as e:
+            logging.error(f"Could not verify audio {key}: {e}")
+        finally:
+            with _audio_lock:
+                _audio_verifying.discard(key)
+
+    run_in_background(target, 'audio-verify')
+
+def send_recitation_audio(chat_id, reciter_key, surah_number, caption):
+    """Sends a recitation as Telegram audio, uploading it on first use.
+
+    Returns False if Telegram could not deliver it, so the caller can fall back
+    to a link. Files Telegram refuses to fetch (e.g. over its 20 MB URL limit)
+    are remembered with an empty file_id and not retried; errors specific to
+    this chat are not remembered.
+    """
+    key = f"{reciter_key}:{surah_number}"
+    file_id = audio_file_ids.get(key)
+    if file_id == '':
+        return False
+    payload = {'chat_id': chat_id, 'caption': caption, 'parse_mode': 'Markdown'}
+    if file_id:
+        reply = call_telegram('sendAudio', {**payload, 'audio': file_id})
+        if reply.get('ok'):
+            return True
+        logging.warning(f"Telegram rejected cached file_id for {key}: {reply.get('description')}")
+        audio_file_ids.pop(key)
+    reply, shared = inflight.do(('audio', key), upload_recitation, payload, reciter_key, surah_number)
+    if shared:
+        # Another chat's upload of the same file just finished; reuse its file_id.
+        file_id = audio_file_ids.get(key)
+        if not file_id:
+            return False
+        reply = call_telegram('sendAudio', {**payload, 'audio': file_id})
+    return bool(reply.get('ok'))
+
+def upload_recitation(payload, reciter_key, surah_number):
+    """Has Telegram fetch the recitation by URL and caches the resulting file_id."""
+    key = f"{reciter_key}:{surah_number}"
+    reply = call_telegram('sendAudio', {**payload, 'audio': audio_url(reciter_key, surah_number)})
+    if reply.get('ok'):
+        audio_file_ids.set(key, reply['result']['audio']['file_id'])
+    else:
+        logging.warning(f"Telegram could not send audio {key} to {payload['chat_id']}: {reply.get('description')}")
+        if audio_unfetchable(reply):
+            audio_file_ids.set(key, '')
+    audio_file_ids.save()
+    return reply
+
+def backfill_audio_file_ids(reciter_keys=None, force=False, deadline=None):
+    """Uploads every missing recitation to AUDIO_CACHE_CHAT_ID to collect file_ids.
+
+    Recitations not reached by `deadline` (a time.monotonic() value) are counted as 'remaining'.
+    """
+    tally = {'cached': 0, 'uploaded': 0, 'failed': 0, 'remaining': 0}
+    for reciter_key in reciter_keys or RECITERS:
+        for surah_number in range(1, 115):
+            key = f"{reciter_key}:{surah_number}"
+            if key in audio_file_ids and not force:
+                tally['cached'] += 1
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                tally['remaining'] += 1
+                continue
+            status, _ = audio_status(reciter_key, surah_number)
+            if status is not None and status != 200:
+                continue
+            _chat_limiter(AUDIO_CACHE_CHAT_ID).acquire()
+            try:
+                reply = call_telegram('sendAudio', {'chat_id': AUDIO_CACHE_CHAT_ID, 'audio': audio_url(reciter_key, surah_number)})
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.error(f"Could not upload audio {key}: {e}")
+                tally['failed'] += 1
+                continue
+            if reply.get('ok'):
+                audio_file_ids.set(key, reply['result']['audio']['file_id'])
+                tally['uploaded'] += 1
+                try:
+                    call_telegram('deleteMessage', {'chat_id': AUDIO_CACHE_CHAT_ID, 'message_id': reply['result']['message_id']})
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logging.warning(f"Could not delete the upload message for {key}: {e}")
+            else:
+                logging.warning(f"Telegram could not fetch audio for {key}: {reply.get('description')}")
+                # Anything else (429s, 5xx) is retried next run.
+                if audio_unfetchable(reply):
+                    audio_file_ids.set(key, '')
+                tally['failed'] += 1
+        audio_file_ids.save()
+    return tally
+
+def prewarm_audio(force=False, workers=8, deadline=None):
+    """Verifies every surah for every reciter that is missing or stale. Returns a status tally.
+
+    Files not reached by `deadline` (a time.monotonic() value) are tallied as 'skipped'.
+    """
+    todo = [(reciter_key, surah_number) for reciter_key in RECITERS for surah_number in range(1, 115)
+            if force or not audio_status(reciter_key, surah_number)[1]]
+
+    def check(item):
+        if deadline is not None and time.monotonic() > deadline:
+            return 'skipped'
+        try:
+            return check_audio(*item)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Could not verify audio {item[0]}:{item[1]}: {e}")
+            return 'error'
+
+    tally = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='audio-prewarm') as pool:
+        for status in pool.map(check, todo):
+            tally[status] = tally.get(status, 0) + 1
+    audio_statuses.save()
+    return tally
+
+
+# --- Message Rendering ---
+# Telegram's limit is 4096 UTF-16 code units per message after entity parsing;
+# counting the Markdown markup too keeps every chunk safely under it.
+TELEGRAM_MESSAGE_LIMIT = 4096
+RENDERED_DIR = os.path.join(CORPUS_DIR, 'rendered')
+render_cache = TTLCache(RENDER_CACHE_SIZE)
+
+def telegram_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def escape_markdown(text):
+    """Escapes the characters legacy Markdown would treat as entity markers."""
+    for char in ('_', '*', '`', '['):
+        text = text.replace(char, '\\' + char)
+    return text
+
+def _split_line(line, limit):
+    """Splits a single over-long line at spaces (or hard, as a last resort)."""
+    pieces, current, size = [], [], 0
+    for word in line.split(' '):
+        word_size = telegram_length(word) + 1
+        if current and size + word_size > limit:
+            pieces.append(' '.join(current) + ' ')
+            current, size = [], 0
+        while word_size > limit:
+            # Half the budget in characters is safe even if every one is astral.
+            pieces.append(word[:limit // 2])
+            word = word[limit // 2:]
+            word_size = telegram_length(word) + 1
+        current.append(word)
+        size += word_size
+    pieces.append(' '.join(current))
+    return pieces
+
+def chunk_lines(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Packs lines into as few messages as possible without splitting a line."""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        line_size = telegram_length(line)
+        for piece in ([line] if line_size <= limit else _split_line(line, limit)):
+            piece_size = line_size if piece is line else telegram_length(piece)
+            if current and size + piece_size > limit:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += piece_size
+    if current:
+        chunks.append(''.join(current))
+    return tuple(chunks)
+
+def render_surah_chunks(surah_number, edition, lang):
+    surah_name, ayahs = fetch_surah(surah_number, edition)
+    lines = [MESSAGES[lang]["surah_header"].format(number=surah_number, name=surah_name) + "\n\n"]
+    lines.extend(f"{number_in_surah}. {escape_markdown(text)}\n" for number_in_surah, text in ayahs)
+    return chunk_lines(lines)
+
+def render_juz_chunks(juz_number, edition, lang):
+    lines = [MESSAGES[lang]["juz_header"].format(number=juz_number) + "\n\n"]
+    current_surah_name = ""
+    for surah_name, number_in_surah, text in fetch_juz(juz_number, edition):
+        if surah_name != current_surah_name:
+            current_surah_name = surah_name
+            lines.append(f"\n--- {current_surah_name} ---\n")
+        lines.append(f"{number_in_surah}. {escape_markdown(text)}\n")
+    return chunk_lines(lines)
+
+RENDERERS = {'surah': render_surah_chunks, 'juz': render_juz_chunks}
+
+def rendered_path(kind, number, edition, lang):
+    return os.path.join(RENDERED_DIR, edition, lang, f"{kind}-{number:03d}.json")
+
+def rendered_chunks(kind, number, lang, edition=QURAN_EDITION):
+    """Returns the message chunks for a surah or juz: memoized, prebuilt, or rendered now."""
+    key = (kind, number, edition, lang)
+    chunks = render_cache.get(key)
+    if chunks is None:
+        def load():
+            loaded = load_chunks(kind, number, lang, edition)
+            render_cache.set(key, loaded)
+            return loaded
+        chunks = inflight.do(('render',) + key, load)[0]
+    return chunks
+
+def load_chunks(kind, number, lang, edition=QURAN_EDITION):
+    """Reads prebuilt chunks from disk, or renders them if none were built."""
+    try:
+        with open(rendered_path(kind, number, edition, lang), encoding='utf-8') as f:
+            return tuple(json.load(f))
+    except FileNotFoundError:
+        return RENDERERS[kind](number, edition, lang)
+
+
+# --- Ayah Lookup & Search ---
+# Arabic is matched without diacritics, Quranic annotation marks or tatweel, and
+# with alef, ya, ta marbuta and hamza-carrier variants folded together.
+ARABIC_MARKS = re.compile('[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')
+ARABIC_FOLDING = str.maketrans({'\u0622': '\u0627', '\u0623': '\u0627', '\u0625': '\u0627', '\u0671': '\u0627',
+                                '\u0649': '\u064A', '\u0626': '\u064A', '\u0624': '\u0648', '\u0629': '\u0647'})
+TOKEN_RE = re.compile(r'\w+')
+SEARCH_SNIPPET_LENGTH = 300
+
+def normalize_text(text):
+    return ARABIC_MARKS.sub('', text).translate(ARABIC_FOLDING).casefold()
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize_text(text))
+
+def parse_ayah_reference(reference):
+    """Parses "2:255" or "2:1-10" into (surah, first, last). Raises ValueError."""
+    surah_part, _, ayah_part = reference.partition(':')
+    first, _, last = ayah_part.partition('-')
+    surah_number, first = int(surah_part), int(first)
+    last = int(last) if last else first
+    if not 1 <= surah_number <= 114 or not 1 <= first <= last <= surah_meta(surah_number)['numberOfAyahs']:
+        raise ValueError("Invalid ayah reference")
+    return surah_number, first, last
+
+class SearchIndex:
+    """Inverted index from normalized terms to ayah numbers, one per bundled edition."""
+
+    def __init__(self, corpora):
+        self.editions = {}
+        for corpus in corpora:
+            postings = {}
+            for number in range(1, TOTAL_AYAHS + 1):
+                for term in set(tokenize(corpus.ayah_text(number))):
+                    postings.setdefault(term, []).append(number)
+            self.editions[corpus.edition] = {term: array('H', numbers) for term, numbers in postings.items()}
+
+    def _hits(self, postings, token):
+        """Ayahs containing the token, or any term containing it if there is no exact match."""
+        if token in postings:
+            return set(postings[token])
+        hits = set()
+        if len(token) >= 3:
+            for term, numbers in postings.items():
+                if token in term:
+                    hits.update(numbers)
+        return hits
+
+    def search(self, query):
+        """Returns [(ayah_number, edition), ...], ayahs matching more and rarer terms first."""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        best = {}
+        for edition, postings in self.editions.items():
+            scores = {}
+            for token in tokens:
+                hits = self._hits(postings, token)
+                if not hits:
+                    continue
+                weight = math.log(1 + TOTAL_AYAHS / len(hits))
+                for number in hits:
+                    matched, total = scores.get(number, (0, 0.0))
+                    scores[number] = (matched + 1, total + weight)
+            for number, score in scores.items():
+                if number not in best or score > best[number][0]:
+                    best[number] = (score, edition)
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0][0], -item[1][0][1], item[0]))
+        return [(number, edition) for number, (_, edition) in ranked]
+
+_search_index = None
+_search_lock = threading.Lock()
+
+def get_search_index():
+    """Builds the search index over every bundled edition on first use. None if nothing is bundled."""
+    global _search_index
+    if _search_index is None:
+        with _search_lock:
+            if _search_index is None:
+                corpora = [corpus for corpus in map(get_corpus, bundled_editions()) if corpus]
+                if not corpora:
+                    return None
+                started = time.perf_counter()
+                _search_index = SearchIndex(corpora)
+                logging.info(f"Built search index over {len(corpora)} editions in {time.perf_counter() - started:.2f}s")
+    return _search_index
+
+# Telegram allows only 64 bytes of callback_data, so paging buttons carry a short
+# id of the query. The query itself is remembered here, and can also be read back
+# from the results header if this instance has not seen it.
+search_queries = TTLCache(10000, ttl=24 * 3600)
+
+def search_query_id(query):
+    return hashlib.blake2s(query.encode('utf-8'), digest_size=6).hexdigest()
+
+def search_callback_data(query, page):
+    """callback_data for a results page."""
+    query_id = search_query_id(query)
+    search_queries.set(query_id, query)
+    return f"search_{page}_{query_id}"
+
+def search_query(query_id, results_text=''):
+    """The query behind a paging button, or None if it cannot be recovered."""
+    query = search_queries.get(query_id)
+    if query is None:
+        # The header reads "🔎 <query> — ..." in every language.
+        header = results_text.split('\n', 1)[0]
+        candidate = header.removeprefix('🔎 ').rsplit(' — ', 1)[0]
+        if search_query_id(candidate) == query_id:
+            query = candidate
+            search_queries.set(query_id, query)
+    return query
+
+def render_search_page(query, results, page, lang):
+    """Returns (text, reply_markup) for one page of search results."""
+    pages = max(1, math.ceil(len(results) / SEARCH_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    lines = [MESSAGES[lang]["search_results"].format(query=escape_markdown(query), total=len(results), page=page + 1, pages=pages), ""]
+    for number, edition in results[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]:
+        surah_number, number_in_surah = ayah_reference(number)
+        text = get_corpus(edition).ayah_text(number)
+        if len(text) > SEARCH_SNIPPET_LENGTH:
+            text = text[:SEARCH_SNIPPET_LENGTH].rsplit(' ', 1)[0] + ' …'
+        lines.append(f"*{surah_number}:{number_in_surah}* ({SURAH_META[surah_number - 1][0]})\n{escape_markdown(text)}\n")
+    buttons = []
+    if page > 0:
+        buttons.append({"text": "◀️", "callback_data": search_callback_data(query, page - 1)})
+    if page < pages - 1:
+        buttons.append({"text": "▶️", "callback_data": search_callback_data(query, page + 1)})
+    return "\n".join(lines), {"inline_keyboard": [buttons]} if buttons else None
 
 
 # --- Bot Feature Functions ---
@@ -176,14 +1862,7 @@ def handle_surah(chat_id, args, lang):
     try:
         surah_number = int(args[0])
         if not 1 <= surah_number <= 114: raise ValueError("Invalid Surah number")
-        response = requests.get(f"{QURAN_API_BASE_URL}/surah/{surah_number}", timeout=10)
-        response.raise_for_status()
-        data = response.json()['data']
-        surah_name = data['englishName']
-        ayahs = data['ayahs']
-        message = f"🕋 *Surah {surah_number}: {surah_name}*\n\n"
-        for ayah in ayahs: message += f"{ayah['numberInSurah']}. {ayah['text']}\n"
-        for i in range(0, len(message), 4096): send_telegram_message(chat_id, message[i:i+4096])
+        for chunk in rendered_chunks('surah', surah_number, lang): send_telegram_message(chat_id, chunk)
     except (ValueError, IndexError):
         send_telegram_message(chat_id, MESSAGES[lang]["surah_prompt"])
     except (requests.exceptions.RequestException, KeyError) as e:
@@ -194,40 +1873,76 @@ def handle_juz(chat_id, args, lang):
     try:
         juz_number = int(args[0])
         if not 1 <= juz_number <= 30: raise ValueError("Invalid Juz number")
-        response = requests.get(f"{QURAN_API_BASE_URL}/juz/{juz_number}", timeout=10)
-        response.raise_for_status()
-        data = response.json()['data']
-        ayahs = data['ayahs']
-        message = f"📗 *Juz' {juz_number}*\n\n"
-        current_surah_name = ""
-        for ayah in ayahs:
-            if ayah['surah']['name'] != current_surah_name:
-                current_surah_name = ayah['surah']['name']
-                message += f"\n--- {current_surah_name} ---\n"
-            message += f"{ayah['numberInSurah']}. {ayah['text']}\n"
-        for i in range(0, len(message), 4096): send_telegram_message(chat_id, message[i:i+4096])
+        for chunk in rendered_chunks('juz', juz_number, lang): send_telegram_message(chat_id, chunk)
     except (ValueError, IndexError):
         send_telegram_message(chat_id, MESSAGES[lang]["juz_prompt"])
     except (requests.exceptions.RequestException, KeyError) as e:
         logging.error(f"API error fetching juz {args[0] if args else 'N/A'}: {e}")
         send_telegram_message(chat_id, MESSAGES[lang]["generic_error"])
 
+def handle_ayah(chat_id, args, lang):
+    try:
+        surah_number, first, last = parse_ayah_reference(args[0])
+        ayahs = fetch_ayahs(surah_number, first, last)
+        reference = f"{surah_number}:{first}" if first == last else f"{surah_number}:{first}-{last}"
+        lines = [MESSAGES[lang]["ayah_header"].format(name=surah_meta(surah_number)['englishName'], reference=reference) + "\n\n"]
+        lines.extend(f"{number_in_surah}. {escape_markdown(text)}\n" for number_in_surah, text in ayahs)
+        for chunk in chunk_lines(lines): send_telegram_message(chat_id, chunk)
+    except (ValueError, IndexError):
+        send_telegram_message(chat_id, MESSAGES[lang]["ayah_prompt"])
+    except (requests.exceptions.RequestException, KeyError) as e:
+        logging.error(f"API error fetching ayah {args[0] if args else 'N/A'}: {e}")
+        send_telegram_message(chat_id, MESSAGES[lang]["generic_error"])
+
+def handle_search(chat_id, args, lang, page=0, message_id=None):
+    """Sends a page of search results, or edits `message_id` in place when paging."""
+    query = " ".join(tokenize(" ".join(args)))
+    if not query:
+        send_telegram_message(chat_id, MESSAGES[lang]["search_prompt"])
+        return
+    index = get_search_index()
+    if index is None:
+        send_telegram_message(chat_id, MESSAGES[lang]["search_unavailable"])
+        return
+    results = index.search(query)
+    if not results:
+        send_telegram_message(chat_id, MESSAGES[lang]["search_no_results"].format(query=escape_markdown(query)))
+        return
+    text, keyboard = render_search_page(query, results, page, lang)
+    if message_id is None:
+        send_telegram_message(chat_id, text, reply_markup=keyboard)
+        return
+    payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text, 'parse_mode': 'Markdown'}
+    if keyboard:
+        payload['reply_markup'] = keyboard
+    try:
+        reply = call_telegram('editMessageText', payload)
+        if not reply.get('ok'):
+            logging.error(f"Failed to edit search results in {chat_id}: {reply.get('description')}")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to edit search results in {chat_id}: {e}")
+
 def handle_recitation(chat_id, args, lang, reciter_key):
     try:
         surah_number = int(args[0])
         if not 1 <= surah_number <= 114: raise ValueError("Invalid Surah number")
         reciter_info = RECITERS[reciter_key]
-        padded_surah_number = str(surah_number).zfill(3)
-        full_audio_url = f"https://download.quranicaudio.com/quran/{reciter_info['identifier']}/{padded_surah_number}.mp3"
-        surah_info_response = requests.get(f"{QURAN_API_BASE_URL}/surah/{surah_number}", timeout=10)
-        surah_info_response.raise_for_status()
-        surah_name_english = surah_info_response.json()['data']['englishName']
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.head(full_audio_url, headers=headers, timeout=10, allow_redirects=True)
-        if response.status_code != 200:
-            logging.warning(f"Audio file not found (HTTP {response.status_code}) at {full_audio_url}")
+        full_audio_url = audio_url(reciter_key, surah_number)
+        surah_name_english = surah_meta(surah_number)['englishName']
+        # Unknown or stale entries are served optimistically and re-checked off the request path.
+        status, fresh = audio_status(reciter_key, surah_number)
+        if not fresh:
+            verify_audio_in_background(reciter_key, surah_number)
+        if status is not None and status != 200:
+            logging.warning(f"Audio file not found (HTTP {status}) at {full_audio_url}")
             send_telegram_message(chat_id, MESSAGES[lang]["error_fetching_audio"].format(full_audio_url=full_audio_url))
             return
+        if AUDIO_DELIVERY == 'file_id':
+            caption = MESSAGES[lang]["audio_caption"].format(reciter_name=reciter_info['name'], surah_name=surah_name_english)
+            try:
+                if send_recitation_audio(chat_id, reciter_key, surah_number, caption): return
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Could not send audio for surah {surah_number}, falling back to a link: {e}")
         message_text = MESSAGES[lang]["audio_link_message"].format(reciter_name=reciter_info['name'], surah_name=surah_name_english, audio_url=full_audio_url)
         send_telegram_message(chat_id, message_text)
     except (ValueError, IndexError):
@@ -240,51 +1955,457 @@ def handle_recitation(chat_id, args, lang, reciter_key):
 # --- Admin Commands ---
 def handle_status(chat_id):
     try:
-        db_data = get_db()
-        user_count = len(db_data.get('users', {}))
-        send_telegram_message(chat_id, f"📊 *Bot Status*\n\nTotal Users: *{user_count}*")
+        user_count = get_store().count_users()
+        writes = lang_writes.stats()
+        membership = membership_cache.stats()
+        pipeline = updates.stats()
+        flood = flood_control.stats()
+        flights = inflight.stats()
+        latency, errors = upstream_snapshot()
+        upstreams = "\n".join(
+            f"  {name}: {h.count} calls, avg {h.sum * 1000 / h.count:.0f} ms, {errors.get(name, 0)} errors"
+            for name, h in sorted(latency.items()) if h.count
+        ) or "  none yet"
+        send_telegram_message(chat_id, (
+            f"📊 *Bot Status*\n\nTotal Users: *{user_count}* ({USER_STORE})\n\n"
+            f"*Language writes:* {writes['updates']} updates, {writes['skipped']} no-ops skipped, "
+            f"{writes['rows_written']} rows in {writes['flushes']} flushes "
+            f"(coalescing {writes['coalescing_ratio']:.2f}x, flush avg {writes['flush_ms_avg']:.1f} ms / max {writes['flush_ms_max']:.1f} ms)\n"
+            f"*Membership cache:* {membership['hits']} hits, {membership['misses']} misses "
+            f"({membership['hit_rate']:.0%} of Telegram checks saved), {membership['size']} entries\n"
+            f"*Updates:* {pipeline['accepted']} accepted, {pipeline['duplicates']} redeliveries dropped, {pipeline['inline']} run inline\n"
+            f"*Flood control:* {flood['throttled']} commands throttled, {flood['notices']} notices sent\n"
+            f"*Collapsed fetches:* {flights['shared']} requests shared {flights['calls']} upstream calls\n"
+            f"*Upstreams:*\n{upstreams}"
+        ))
     except Exception as e:
         logging.error(f"Error getting status: {e}")
         send_telegram_message(chat_id, f"❌ Could not get status. DB Error: `{e}`")
 
+def handle_stats(chat_id):
+    window_minutes = STATS_WINDOW_SECONDS // 60
+    lines = [f"⏱ *Command latency* (last {window_minutes} min)", ""]
+    for name, entry in sorted(command_metrics.snapshot().items()):
+        samples, (p50, p95) = command_metrics.percentiles(name)
+        if not samples:
+            continue
+        phases = ", ".join(f"{phase} {seconds * 1000 / entry['calls']:.0f}" for phase, seconds in entry['phases'].items() if seconds)
+        lines.append(f"`{name}` {samples} calls, {entry['errors']} errors total — p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms"
+                     + (f"\n    avg ms per phase: {phases}" if phases else ""))
+    if len(lines) == 2:
+        lines.append("No commands in this window yet.")
+    send_telegram_message(chat_id, "\n".join(lines))
+
+def handle_prewarm_audio(chat_id, force=False):
+    send_telegram_message(chat_id, f"🔎 Verifying audio for {len(RECITERS)} reciters x 114 surahs...")
+
+    def target():
+        try:
+            tally = prewarm_audio(force=force, deadline=job_deadline())
+            summary = ", ".join(f"{status}: {count}" for status, count in sorted(tally.items(), key=str)) or "everything was fresh"
+            send_telegram_message(chat_id, f"✅ Audio cache verified ({summary})."
+                                  + (" Run /prewarm\\_audio again for the skipped files." if tally.get('skipped') else ""))
+        except Exception as e:
+            logging.error(f"Audio prewarm failed: {e}", exc_info=True)
+            send_telegram_message(chat_id, f"❌ Audio prewarm failed: `{e}`")
+
+    run_in_background(target, 'audio-prewarm')
+
+
+def handle_backfill_audio(chat_id, args):
+    reciter_keys = [arg for arg in args if arg in RECITERS]
+    force = 'force' in args
+    if not AUDIO_CACHE_CHAT_ID:
+        send_telegram_message(chat_id, "❌ Set AUDIO\\_CACHE\\_CHAT\\_ID or ADMIN\\_ID first.")
+        return
+    send_telegram_message(chat_id, f"⬆️ Uploading recitations for {', '.join(reciter_keys or RECITERS)}...")
+
+    def target():
+        try:
+            tally = backfill_audio_file_ids(reciter_keys, force=force, deadline=job_deadline())
+            send_telegram_message(chat_id, f"✅ Audio backfill done: {tally['uploaded']} uploaded, {tally['cached']} already cached, {tally['failed']} failed."
+                                  + (f" {tally['remaining']} left for the next /backfill\\_audio." if tally['remaining'] else ""))
+        except Exception as e:
+            logging.error(f"Audio backfill failed: {e}", exc_info=True)
+            send_telegram_message(chat_id, f"❌ Audio backfill failed: `{e}`")
+
+    run_in_background(target, 'audio-backfill')
+
+
+# --- Broadcasts ---
+BROADCAST_STATE_KEY = 'broadcast'
+broadcast_limiter = TokenBucket(BROADCAST_RATE)
+chat_limiters = TTLCache(10000, ttl=60)
+_broadcast_lock = threading.Lock()
+
+def _chat_limiter(chat_id):
+    limiter = chat_limiters.get(chat_id)
+    if limiter is None:
+        limiter = TokenBucket(1, 1)
+        chat_limiters.set(chat_id, limiter)
+    return limiter
+
+def send_broadcast_message(chat_id, text, max_attempts=3):
+    """Sends one broadcast message. Returns 'sent', 'blocked' or 'failed'."""
+    url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+    payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'}
+    for _ in range(max_attempts):
+        broadcast_limiter.acquire()
+        _chat_limiter(chat_id).acquire()
+        try:
+            # Retries are handled here so a 429 also pauses the global bucket.
+            response = http_request('POST', url, 'telegram/sendMessage', retries=0, json=payload)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to send broadcast to user {chat_id}: {e}")
+            # Telegram may already have the message unless the connection never opened.
+            if _never_sent(e):
+                continue
+            return 'failed'
+        if response.status_code == 200:
+            return 'sent'
+        if response.status_code == 429:
+            retry_after = _retry_after(response) or 1
+            logging.warning(f"Broadcast rate limited, retrying after {retry_after}s")
+            broadcast_limiter.pause(retry_after)
+            continue
+        if response.status_code == 403:
+            return 'blocked'
+        logging.error(f"Failed to send broadcast to user {chat_id}: HTTP {response.status_code} {response.text}")
+        return 'failed'
+    return 'failed'
+
+def run_broadcast(job, deadline=None):
+    """Sends `job` to every active user after its checkpoint, saving progress per batch.
+
+    Stops at the first batch boundary after `deadline` (a time.monotonic() value),
+    leaving the job resumable with /broadcast_resume.
+    """
+    store = get_store()
+    admin_id = job['admin_id']
+    users = [user_id for user_id in store.user_ids(active_only=True) if user_id > job['cursor']]
+    if not job['total']:
+        job['total'] = len(users)
+    last_progress = time.monotonic()
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix='broadcast') as pool:
+        for i in range(0, len(users), BROADCAST_BATCH_SIZE):
+            batch = users[i:i + BROADCAST_BATCH_SIZE]
+            blocked = []
+            for user_id, result in zip(batch, pool.map(lambda uid: send_broadcast_message(uid, job['text']), batch)):
+                job[result] += 1
+                if result == 'blocked':
+                    blocked.append(user_id)
+            # One write per batch: on JSONBin every write is a GET and PUT of the whole bin.
+            if blocked:
+                store.mark_blocked_many(blocked)
+            job['cursor'] = batch[-1]
+            store.set_meta(BROADCAST_STATE_KEY, job)
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_SECONDS:
+                last_progress = time.monotonic()
+                done = job['sent'] + job['blocked'] + job['failed']
+                send_telegram_message(admin_id, f"⏳ Broadcast progress: {done} of {job['total']} users ({job['sent']} sent, {job['blocked']} blocked, {job['failed']} failed).")
+            if deadline is not None and time.monotonic() > deadline and i + BROADCAST_BATCH_SIZE < len(users):
+                done = job['sent'] + job['blocked'] + job['failed']
+                send_telegram_message(admin_id, f"⏸ Broadcast paused after {done} of {job['total']} users to stay within the time limit. Send /broadcast\\_resume to continue.")
+                return
+    job['status'] = 'done'
+    store.set_meta(BROADCAST_STATE_KEY, job)
+    send_telegram_message(admin_id, f"✅ Broadcast finished. Sent to *{job['sent']}* of *{job['total']}* users ({job['blocked']} blocked the bot, {job['failed']} failed).")
+
+def _start_broadcast_thread(job):
+    """Runs `job` in the background. The caller must hold _broadcast_lock."""
+    def target():
+        try:
+            run_broadcast(job, deadline=job_deadline())
+        except Exception as e:
+            logging.error(f"Broadcast failed: {e}", exc_info=True)
+            send_telegram_message(job['admin_id'], f"❌ Broadcast interrupted: `{e}`\nUse /broadcast\\_resume to continue.")
+        finally:
+            _broadcast_lock.release()
+
+    run_in_background(target, 'broadcast')
+
 def handle_broadcast(admin_id, message_text):
+    if not _broadcast_lock.acquire(blocking=False):
+        send_telegram_message(admin_id, "⚠️ A broadcast is already running.")
+        return
     try:
-        db_data = get_db()
-        users = db_data.get('users', {}).keys()
-        if not users:
+        total_users = len(get_store().user_ids(active_only=True))
+        if not total_users:
             send_telegram_message(admin_id, "No users in the database to broadcast to.")
+            _broadcast_lock.release()
             return
-        sent_count = 0
-        total_users = len(users)
+        job = {'id': str(int(time.time())), 'admin_id': admin_id, 'text': message_text, 'cursor': '',
+               'total': total_users, 'sent': 0, 'blocked': 0, 'failed': 0, 'status': 'running'}
+        get_store().set_meta(BROADCAST_STATE_KEY, job)
         send_telegram_message(admin_id, f"📣 Starting broadcast to {total_users} users...")
-        for user_id in users:
-            try:
-                send_telegram_message(user_id, message_text)
-                sent_count += 1
-                time.sleep(0.1) # Avoid hitting rate limits
-            except Exception as e:
-                logging.error(f"Failed to send broadcast to user {user_id}: {e}")
-        send_telegram_message(admin_id, f"✅ Broadcast finished. Sent to *{sent_count}* of *{total_users}* users.")
+        _start_broadcast_thread(job)
     except Exception as e:
+        _broadcast_lock.release()
         logging.error(f"Broadcast failed: {e}")
         send_telegram_message(admin_id, f"❌ Broadcast failed. DB Error: `{e}`")
 
+def handle_broadcast_resume(admin_id):
+    if not _broadcast_lock.acquire(blocking=False):
+        send_telegram_message(admin_id, "⚠️ A broadcast is already running.")
+        return
+    try:
+        job = get_store().get_meta(BROADCAST_STATE_KEY)
+        if not job or job.get('status') != 'running':
+            send_telegram_message(admin_id, "No interrupted broadcast to resume.")
+            _broadcast_lock.release()
+            return
+        done = job['sent'] + job['blocked'] + job['failed']
+        send_telegram_message(admin_id, f"📣 Resuming broadcast after {done} of {job['total']} users...")
+        job['admin_id'] = admin_id
+        _start_broadcast_thread(job)
+    except Exception as e:
+        _broadcast_lock.release()
+        logging.error(f"Broadcast resume failed: {e}")
+        send_telegram_message(admin_id, f"❌ Broadcast resume failed. DB Error: `{e}`")
+
+
+# --- Command Dispatch ---
+# Handlers take a CommandContext; admin-only commands are ignored for everyone else.
+CommandContext = namedtuple('CommandContext', 'chat_id user_id user_name args lang is_admin')
+CommandEntry = namedtuple('CommandEntry', 'handler admin')
+COMMANDS = {}
+
+def command(*names, admin=False):
+    def register(handler):
+        for name in names:
+            COMMANDS[name] = CommandEntry(handler, admin)
+        return handler
+    return register
+
+@command('/start')
+def cmd_start(ctx):
+    set_user_lang(ctx.user_id, ctx.lang)
+    send_telegram_message(ctx.chat_id, MESSAGES[ctx.lang]["welcome"].format(username=ctx.user_name))
+
+@command('/language')
+def cmd_language(ctx):
+    send_telegram_message(ctx.chat_id, MESSAGES[ctx.lang]["language_prompt"], reply_markup=LANGUAGE_KEYBOARD)
+
+@command('/surah')
+def cmd_surah(ctx):
+    handle_surah(ctx.chat_id, ctx.args, ctx.lang)
+
+@command('/juz')
+def cmd_juz(ctx):
+    handle_juz(ctx.chat_id, ctx.args, ctx.lang)
+
+@command('/ayah')
+def cmd_ayah(ctx):
+    handle_ayah(ctx.chat_id, ctx.args, ctx.lang)
+
+@command('/search')
+def cmd_search(ctx):
+    handle_search(ctx.chat_id, ctx.args, ctx.lang)
+
+@command('/support')
+def cmd_support(ctx):
+    if not ctx.args:
+        send_telegram_message(ctx.chat_id, MESSAGES[ctx.lang]["support_prompt"])
+    else:
+        support_message = " ".join(ctx.args)
+        forward_message = f"🆘 *New Support Message*\n\n*From:* {ctx.user_name} (ID: `{ctx.user_id}`)\n\n*Message:* {support_message}"
+        if ADMIN_ID: send_telegram_message(ADMIN_ID, forward_message)
+        send_telegram_message(ctx.chat_id, MESSAGES[ctx.lang]["support_sent"])
+
+@command('/status', admin=True)
+def cmd_status(ctx):
+    handle_status(ctx.chat_id)
+
+@command('/stats', admin=True)
+def cmd_stats(ctx):
+    handle_stats(ctx.chat_id)
+
+@command('/broadcast', admin=True)
+def cmd_broadcast(ctx):
+    if not ctx.args:
+        send_telegram_message(ctx.chat_id, "Usage: `/broadcast <message>`")
+    else:
+        handle_broadcast(ctx.chat_id, " ".join(ctx.args))
+
+@command('/broadcast_resume', admin=True)
+def cmd_broadcast_resume(ctx):
+    handle_broadcast_resume(ctx.chat_id)
+
+@command('/prewarm_audio', admin=True)
+def cmd_prewarm_audio(ctx):
+    handle_prewarm_audio(ctx.chat_id, force='force' in ctx.args)
+
+@command('/backfill_audio', admin=True)
+def cmd_backfill_audio(ctx):
+    handle_backfill_audio(ctx.chat_id, ctx.args)
+
+def _register_reciter(reciter_key):
+    names = [f"/{alias}" for alias in [reciter_key] + RECITERS[reciter_key].get('aliases', [])]
+
+    @command(*names)
+    def cmd_recitation(ctx):
+        handle_recitation(ctx.chat_id, ctx.args, ctx.lang, reciter_key)
+
+for _reciter_key in RECITERS:
+    _register_reciter(_reciter_key)
+
+
+# --- Update Processing ---
+class UpdatePipeline:
+    """Runs updates on a bounded worker pool and drops redelivered update_ids."""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max(workers + queue_size, 1))
+        self._lock = threading.Lock()
+        # Telegram keeps undelivered updates for 24 hours.
+        self.seen = TTLCache(50000, ttl=24 * 3600)
+        self.accepted = 0
+        self.duplicates = 0
+        self.inline = 0
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='update')
+        return self._executor
+
+    def submit(self, update, handler=None):
+        """Queues an update for `handler` (run_update by default). Returns False if it was already seen."""
+        handler = handler or run_update
+        update_id = update.get('update_id')
+        with self._lock:
+            if update_id is not None and self.seen.peek(update_id):
+                self.duplicates += 1
+                return False
+            self.seen.set(update_id, True)
+            self.accepted += 1
+        if self.workers <= 0 or not self._slots.acquire(blocking=False):
+            self.inline += 1
+            handler(update)
+            return True
+        self._pool().submit(self._run, handler, update)
+        return True
+
+    def _run(self, handler, update):
+        try:
+            handler(update)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {'accepted': self.accepted, 'duplicates': self.duplicates, 'inline': self.inline}
+
+updates = UpdatePipeline(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+_after_update = threading.local()
+
+def run_in_background(target, name):
+    """Runs `target` off the request path: in a thread, or on serverless hosts
+    right after the current update has been handled (before webhook() returns)."""
+    if not SERVERLESS:
+        threading.Thread(target=target, name=name, daemon=True).start()
+        return
+    pending = getattr(_after_update, 'tasks', None)
+    if pending is None:
+        target()
+    else:
+        pending.append(target)
+
+def job_deadline():
+    """time.monotonic() by which a long admin job must stop, or None if it may run to completion."""
+    return time.monotonic() + SERVERLESS_TIME_BUDGET if SERVERLESS else None
+
+def run_update(update):
+    """Handles one update, then writes any pending language updates."""
+    _after_update.tasks = []
+    try:
+        process_update(update)
+    finally:
+        tasks, _after_update.tasks = _after_update.tasks, None
+        lang_writes.flush()
+        for task in tasks:
+            try:
+                task()
+            except Exception as e:
+                logging.error(f"Deferred task failed: {e}", exc_info=True)
+
 
 # --- Webhook Handler ---
 @app.route('/', methods=['POST'])
 def webhook():
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+        return 'bad request', 400
+    sender = update_sender(update)
+    if sender and str(sender[1]) != ADMIN_ID and not flood_control.allow(sender[1]):
+        if flood_control.should_notify(sender[1]):
+            updates.submit(update, notify_throttled)
+        return 'ok', 200
+    updates.submit(update)
+    return 'ok', 200
+
+def update_sender(update):
+    """(chat_id, user_id) of a command or button press, or None for anything else."""
     try:
-        update = request.get_json()
+        if 'callback_query' in update:
+            query = update['callback_query']
+            return query['message']['chat']['id'], query['from']['id']
+        message = update.get('message')
+        if message and message.get('text', '').startswith('/'):
+            return message['chat']['id'], message['from']['id']
+    except (KeyError, TypeError):
+        pass
+    return None
+
+def notify_throttled(update):
+    """Politely tells a flooding user to slow down."""
+    trace = begin_trace()
+    trace.name = 'throttled'
+    try:
+        chat_id, user_id = update_sender(update)
+        lang = get_user_data(user_id).get('lang', 'am')
+        send_telegram_message(chat_id, MESSAGES[lang]["rate_limited"])
+    except Exception as e:
+        trace.error = True
+        logging.error(f"Could not send throttle notice: {e}")
+    finally:
+        end_trace()
+
+def process_update(update):
+    """Routes one Telegram update to its handler, timing it under the command's name."""
+    trace = begin_trace()
+    try:
+        if 'chat_member' in update:
+            # Sent for our channel when the bot is an admin there and the webhook
+            # was registered with "chat_member" in allowed_updates, which Telegram
+            # never includes by default; scripts/set_webhook.py does this.
+            invalidate_membership(update['chat_member']['new_chat_member']['user']['id'])
+            return
 
         if 'callback_query' in update:
             callback_data = update['callback_query']['data']
             chat_id = update['callback_query']['message']['chat']['id']
             user_id = update['callback_query']['from']['id']
             if callback_data.startswith('set_lang_'):
+                trace.name = 'callback:set_lang'
                 lang_code = callback_data.split('_')[-1]
                 set_user_lang(user_id, lang_code)
                 send_telegram_message(chat_id, MESSAGES[lang_code]["language_selected"])
-            return 'ok', 200
+            elif callback_data.startswith('search_'):
+                trace.name = 'callback:search'
+                _, page, query_id = callback_data.split('_', 2)
+                lang = get_user_data(user_id).get('lang', 'am')
+                query = search_query(query_id, update['callback_query']['message'].get('text', ''))
+                answer = {'callback_query_id': update['callback_query']['id']}
+                if query is None:
+                    answer['text'] = MESSAGES[lang]["search_expired"]
+                call_telegram('answerCallbackQuery', answer)
+                if query is not None:
+                    handle_search(chat_id, [query], lang, page=int(page), message_id=update['callback_query']['message']['message_id'])
+            return
 
         if 'message' in update:
             message = update['message']
@@ -293,67 +2414,52 @@ def webhook():
             user_name = message['from'].get('first_name', 'User')
             text = message.get('text', '')
 
-            if not text.startswith('/'): return 'ok', 200
+            if not text.startswith('/'): return
+
+            command_parts = text.split()
+            command_name = command_parts[0].lower()
+            args = command_parts[1:]
+            entry = COMMANDS.get(command_name)
+            trace.name = command_name if entry else 'unknown'
 
             user_data = get_user_data(user_id)
             lang = user_data.get('lang', 'am')
             is_admin = str(user_id) == ADMIN_ID
 
             if not is_admin and not is_user_member(user_id):
+                trace.name = 'join_prompt'
                 channel_name = CHANNEL_ID.replace('@', '') if CHANNEL_ID else ''
                 if channel_name:
                     keyboard = {"inline_keyboard": [[{"text": MESSAGES[lang]["join_button_text"], "url": f"https://t.me/{channel_name}"}]]}
                     send_telegram_message(chat_id, MESSAGES[lang]["force_join"], reply_markup=keyboard)
                 else:
                     send_telegram_message(chat_id, MESSAGES[lang]["force_join"])
-                return 'ok', 200
+                return
 
-            command_parts = text.split()
-            command = command_parts[0].lower()
-            args = command_parts[1:]
-
-            if command == '/start':
-                set_user_lang(user_id, lang)
-                send_telegram_message(chat_id, MESSAGES[lang]["welcome"].format(username=user_name))
-            elif command == '/language':
-                keyboard = {"inline_keyboard": [[{"text": "አማርኛ", "callback_data": "set_lang_am"}, {"text": "English", "callback_data": "set_lang_en"}], [{"text": "العربية", "callback_data": "set_lang_ar"}, {"text": "Türkçe", "callback_data": "set_lang_tr"}]]}
-                send_telegram_message(chat_id, MESSAGES[lang]["language_prompt"], reply_markup=keyboard)
-            elif command == '/surah':
-                handle_surah(chat_id, args, lang)
-            elif command == '/juz':
-                handle_juz(chat_id, args, lang)
-            elif command == '/support':
-                if not args:
-                    send_telegram_message(chat_id, MESSAGES[lang]["support_prompt"])
-                else:
-                    support_message = " ".join(args)
-                    forward_message = f"🆘 *New Support Message*\n\n*From:* {user_name} (ID: `{user_id}`)\n\n*Message:* {support_message}"
-                    if ADMIN_ID: send_telegram_message(ADMIN_ID, forward_message)
-                    send_telegram_message(chat_id, MESSAGES[lang]["support_sent"])
-            elif is_admin and command == '/status':
-                handle_status(chat_id)
-            elif is_admin and command == '/broadcast':
-                if not args:
-                    send_telegram_message(chat_id, "Usage: `/broadcast <message>`")
-                else:
-                    handle_broadcast(chat_id, " ".join(args))
-            else:
-                reciter_command = command.replace('/', '')
-                if reciter_command in RECITERS:
-                    handle_recitation(chat_id, args, lang, reciter_command)
+            if entry is None or (entry.admin and not is_admin):
+                return
+            entry.handler(CommandContext(chat_id, user_id, user_name, args, lang, is_admin))
 
     except Exception as e:
+        trace.error = True
         logging.error(f"!!! CRITICAL ERROR IN WEBHOOK: {e}", exc_info=True)
         if ADMIN_ID:
             try:
                 send_telegram_message(ADMIN_ID, f"🚨 Critical Bot Error 🚨\n\nAn error occurred: {e}")
             except:
                 pass
-    return 'ok', 200
+    finally:
+        end_trace()
 
 @app.route('/', methods=['GET'])
 def index():
     return "Quran Bot is running.", 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS_TOKEN and request.args.get('token') != METRICS_TOKEN:
+        return 'forbidden', 403
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,128 @@
+"""Benchmarks cold start of the serverless entry point api/index.py.
+
+Usage:
+    python scripts/bench_startup.py [--runs N] [--command TEXT]
+                                    [--max-import-ms MS] [--max-first-response-ms MS]
+
+Every run starts a fresh interpreter, imports the module and posts one update
+to webhook() through Flask's test client, processed inline as on Vercel.
+Outbound HTTP is stubbed at the transport level (a fake adapter mounted on the
+bot's session), so loading requests and building the session are still paid
+on the first update. It reports the import time, the time until webhook()
+returns (what Telegram waits for), and the time until the update has been
+fully handled. Runs are done both from source and from precompiled bytecode,
+since serverless hosts often cannot write __pycache__. Exits non-zero if a
+median exceeds the limits.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, API_DIR)
+import index
+imported = time.perf_counter()
+
+sent = []
+real_session = index.get_http_session
+
+def stub_session():
+    # Runs on the first outbound call, so importing requests is still timed.
+    session = real_session()
+    if not sent:
+        import requests
+
+        class StubAdapter(requests.adapters.BaseAdapter):
+            def send(self, request, **kwargs):
+                method = request.url.split('?')[0].rsplit('/', 1)[-1]
+                sent.append(method)
+                result = {'status': 'member'} if method == 'getChatMember' else {}
+                response = requests.Response()
+                response.status_code = 200
+                response._content = json.dumps({'ok': True, 'result': result}).encode()
+                response.headers['Content-Type'] = 'application/json'
+                response.url = request.url
+                response.request = request
+                return response
+
+            def close(self):
+                pass
+
+        session.mount('https://', StubAdapter())
+        session.mount('http://', StubAdapter())
+        sent.append('mounted')
+    return session
+
+index.get_http_session = stub_session
+client = index.app.test_client()
+update = {'update_id': 1, 'message': {'from': {'id': 1, 'first_name': 'Bench'}, 'chat': {'id': 1}, 'text': COMMAND}}
+before = time.perf_counter()
+status = client.post('/', json=update).status_code
+responded = time.perf_counter()
+while 'sendMessage' not in sent and time.perf_counter() - responded < 10:
+    time.sleep(0.0005)
+handled = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (responded - before) * 1000,
+    'handled_ms': (handled - before) * 1000,
+    'status': status,
+    'requests_loaded': 'urllib3' in sys.modules,
+}))
+'''
+
+
+def run_once(command, env):
+    code = CHILD.replace('API_DIR', repr(API_DIR)).replace('COMMAND', repr(command))
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench(mode, command, runs, workdir):
+    env = dict(os.environ, CHANNEL_ID='@bench', USER_STORE='sqlite', USER_DB_PATH=os.path.join(workdir, 'bench.db'), SERVERLESS='1')
+    env.pop('JSONBIN_BIN_ID', None)
+    if mode == 'source':
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+    else:
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPYCACHEPREFIX'] = os.path.join(workdir, 'pycache')
+        run_once(command, env)  # populate the bytecode cache
+    return [run_once(command, env) for _ in range(runs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--command', default='/start')
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-first-response-ms', type=float)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ('source', 'bytecode'):
+            results = bench(mode, args.command, args.runs, workdir)
+            medians = {key: statistics.median(r[key] for r in results) for key in ('import_ms', 'first_response_ms', 'handled_ms')}
+            print(f"{mode:>8}: import {medians['import_ms']:.1f} ms, "
+                  f"first response {medians['first_response_ms']:.1f} ms, "
+                  f"handled {medians['handled_ms']:.1f} ms "
+                  f"(median of {args.runs}; requests loaded: {results[-1]['requests_loaded']})")
+            if args.max_import_ms is not None and medians['import_ms'] > args.max_import_ms:
+                print(f"  import time exceeds {args.max_import_ms} ms")
+                failed = True
+            if args.max_first_response_ms is not None and medians['first_response_ms'] > args.max_first_response_ms:
+                print(f"  first response exceeds {args.max_first_response_ms} ms")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
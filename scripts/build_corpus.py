@@ -0,0 +1,91 @@
+"""Builds the bundled Quran corpus read by api/index.py.
+
+Usage:
+    python scripts/build_corpus.py [--dump FILE] [EDITION ...]
+
+Each edition is taken from an alquran.cloud full-Quran dump, i.e. the JSON
+returned by GET /v1/quran/<edition>. With --dump the first edition is read
+from FILE instead of being downloaded. Defaults to the bot's QURAN_EDITION.
+Deployments run it through the buildCommand in vercel.json; the output in
+api/data is bundled with the function but not checked in.
+"""
+import argparse
+import json
+import os
+import sys
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import index  # noqa: E402
+
+
+def load_dump(edition, dump_path=None):
+    if dump_path:
+        with open(dump_path, encoding='utf-8') as f:
+            payload = json.load(f)
+    else:
+        response = index.http_request('GET', f"{index.QURAN_API_BASE_URL}/quran/{edition}", 'alquran/quran', timeout=60)
+        response.raise_for_status()
+        payload = response.json()
+    return payload.get('data', payload)
+
+
+def build_index(data):
+    """Surah metadata plus first-ayah tables for surahs, juz and pages."""
+    surahs, juz_start, page_start = [], [], []
+    start = 0
+    for surah in data['surahs']:
+        ayahs = surah['ayahs']
+        surahs.append({
+            'number': surah['number'],
+            'name': surah['name'],
+            'englishName': surah['englishName'],
+            'revelationType': surah.get('revelationType'),
+            'start': start,
+            'count': len(ayahs),
+        })
+        for ayah in ayahs:
+            if ayah['juz'] > len(juz_start): juz_start.append(ayah['number'] - 1)
+            if ayah['page'] > len(page_start): page_start.append(ayah['number'] - 1)
+        start += len(ayahs)
+    if start != index.TOTAL_AYAHS:
+        raise ValueError(f"Expected {index.TOTAL_AYAHS} ayahs, dump has {start}")
+    return {'surahs': surahs, 'juz_start': juz_start + [start], 'page_start': page_start + [start]}
+
+
+def write_edition(edition, data):
+    text_path, offsets_path = index.corpus_paths(edition)
+    offsets = array('I', [0])
+    with open(text_path, 'wb') as blob:
+        for surah in data['surahs']:
+            for ayah in surah['ayahs']:
+                encoded = ayah['text'].encode('utf-8')
+                blob.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+    if len(offsets) != index.TOTAL_AYAHS + 1:
+        raise ValueError(f"{edition}: expected {index.TOTAL_AYAHS} ayahs, dump has {len(offsets) - 1}")
+    size = offsets[-1]
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    with open(offsets_path, 'wb') as f:
+        offsets.tofile(f)
+    print(f"{edition}: {size} bytes -> {text_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('editions', nargs='*', default=[index.QURAN_EDITION])
+    parser.add_argument('--dump', help='alquran.cloud dump to use for the first edition')
+    args = parser.parse_args()
+
+    os.makedirs(index.CORPUS_DIR, exist_ok=True)
+    for i, edition in enumerate(args.editions):
+        data = load_dump(edition, args.dump if i == 0 else None)
+        if i == 0:
+            with open(os.path.join(index.CORPUS_DIR, index.CORPUS_INDEX_FILE), 'w', encoding='utf-8') as f:
+                json.dump(build_index(data), f, ensure_ascii=False, separators=(',', ':'))
+        write_edition(edition, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Imports the existing JSONBin user document into the SQLite store.
+
+Usage:
+    python scripts/migrate_users.py [--from-file FILE] [--db PATH]
+
+Reads {"users": {...}} from JSONBin (JSONBIN_API_KEY / JSONBIN_BIN_ID) or from
+a local export, and upserts every user into the SQLite database at USER_DB_PATH.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import index  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--from-file', help='JSON export of the bin instead of fetching it')
+    parser.add_argument('--db', default=index.USER_DB_PATH, help='SQLite database to write')
+    args = parser.parse_args()
+
+    if args.from_file:
+        with open(args.from_file, encoding='utf-8') as f:
+            db_data = json.load(f)
+    else:
+        db_data = index.get_db()
+    users = db_data.get('users', {})
+
+    store = index.SQLiteBackend(args.db)
+    store.import_users(users)
+    print(f"Imported {len(users)} users into {args.db} ({store.count_users()} total)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Pre-renders the /surah and /juz replies so the bot only has to send them.
+
+Usage:
+    python scripts/prerender.py [--edition EDITION] [LANG ...]
+
+Writes the message chunks for all 114 surahs and 30 juz, per language, under
+<corpus dir>/rendered/<edition>/<lang>/. Defaults to every bot language.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import index  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('langs', nargs='*', default=list(index.MESSAGES))
+    parser.add_argument('--edition', default=index.QURAN_EDITION)
+    args = parser.parse_args()
+
+    for lang in args.langs:
+        written = 0
+        for kind, count in (('surah', 114), ('juz', 30)):
+            for number in range(1, count + 1):
+                path = index.rendered_path(kind, number, args.edition, lang)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(index.RENDERERS[kind](number, args.edition, lang), f, ensure_ascii=False)
+                written += 1
+        print(f"{args.edition}/{lang}: {written} replies")
+
+
+if __name__ == '__main__':
+    main()
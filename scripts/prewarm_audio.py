@@ -0,0 +1,38 @@
+"""Verifies recitation audio for every reciter and surah and saves the results.
+
+Usage:
+    python scripts/prewarm_audio.py [--force] [--bundle]
+
+Only entries that are missing or past their TTL are checked unless --force is
+given. Results go to the bot's cache store. With --bundle they are also written
+to api/data/audio_status.json, which deployments ship with the function (see
+the buildCommand in vercel.json) so fresh instances start with them.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import index  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--force', action='store_true', help='re-check entries that are still fresh')
+    parser.add_argument('--bundle', action='store_true', help='also write the results to AUDIO_STATUS_BUNDLE')
+    args = parser.parse_args()
+
+    tally = index.prewarm_audio(force=args.force)
+    for status, count in sorted(tally.items(), key=str):
+        print(f"{status}: {count}")
+    if args.bundle:
+        os.makedirs(os.path.dirname(index.AUDIO_STATUS_BUNDLE), exist_ok=True)
+        statuses = index.audio_statuses.snapshot()
+        with open(index.AUDIO_STATUS_BUNDLE, 'w', encoding='utf-8') as f:
+            json.dump(statuses, f, separators=(',', ':'))
+        print(f"{len(statuses)} entries -> {index.AUDIO_STATUS_BUNDLE}")
+
+
+if __name__ == '__main__':
+    main()
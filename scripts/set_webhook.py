@@ -0,0 +1,33 @@
+"""Registers the bot's webhook with the update types it handles.
+
+Usage:
+    python scripts/set_webhook.py URL
+
+Telegram only sends "chat_member" updates when they are listed explicitly in
+allowed_updates. The bot uses them to drop a user's cached channel membership
+as soon as they join or leave CHANNEL_ID (the bot must be an admin there).
+Without them, membership changes take effect when the cached answer expires.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import index  # noqa: E402
+
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', help='public URL of the deployed webhook, e.g. https://<app>.vercel.app/')
+    args = parser.parse_args()
+
+    reply = index.call_telegram('setWebhook', {'url': args.url, 'allowed_updates': ALLOWED_UPDATES})
+    if not reply.get('ok'):
+        sys.exit(f"setWebhook failed: {reply.get('description')}")
+    print(f"Webhook set to {args.url} for {', '.join(ALLOWED_UPDATES)}")
+
+
+if __name__ == '__main__':
+    main()